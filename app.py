@@ -1,12 +1,33 @@
-from flask import Flask, render_template, render_template_string, request, redirect, url_for, session, send_file, make_response
+from flask import Flask, Response, render_template, render_template_string, request, redirect, url_for, session, send_file, make_response, jsonify, g, has_request_context
 import pandas as pd
+import io
+import csv
 from io import BytesIO
 import os
 import re
-from datetime import datetime
+import hashlib
+import json
+import math
+import shutil
+import threading
+import time
+import sqlite3
+import uuid
+import zipfile
+from collections import Counter, OrderedDict
+from contextlib import contextmanager, closing, ExitStack
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from datetime import datetime, date, time as dt_time, timedelta
+from decimal import Decimal
 import tempfile
 import openai
 import duckdb
+try:
+    import fcntl
+except ImportError:  # Windows: the dataset store lock then only coordinates threads of one process
+    fcntl = None
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'  # Replace with a secure key
@@ -14,6 +35,125 @@ app.secret_key = 'your_secret_key'  # Replace with a secure key
 UPLOAD_FOLDER = 'uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Uploads are streamed to disk in chunks while being hashed and stored as uploads/<sha256>/<name>,
+# so identical bytes are kept and ingested once for every session; larger requests or files are refused
+MAX_UPLOAD_BYTES = int(os.environ.get('QUERYX_MAX_UPLOAD_MB', '500')) * 1024 * 1024
+MAX_FILE_BYTES = int(os.environ.get('QUERYX_MAX_FILE_MB', '200')) * 1024 * 1024
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# GET /api/datasets lists only the workbooks the caller's session uploaded; the session cookie
+# remembers this many of the most recent ones
+SESSION_DATASETS = int(os.environ.get('QUERYX_SESSION_DATASETS', '20'))
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+# Start scanning and ingesting workbooks in the background as soon as they are uploaded,
+# so the mapping and rules pages usually find them ready
+EAGER_INGEST = os.environ.get('QUERYX_EAGER_INGEST', '1').lower() in ('1', 'true', 'yes')
+
+# Parsed sheets are cached here, one directory per workbook content hash: Parquet while ingesting,
+# then one read-only DuckDB file per workbook that every worker process attaches instead of
+# loading its own copy; a file lock makes sure only one process builds it
+CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, '.cache')
+os.makedirs(CACHE_FOLDER, exist_ok=True)
+
+# Loaded DuckDB connections are pooled across requests; least recently used ones are
+# closed once their combined memory passes the budget or they sit idle too long
+CONNECTION_MEMORY_BUDGET = int(os.environ.get('QUERYX_CONNECTION_MEMORY_MB', '1024')) * 1024 * 1024
+CONNECTION_IDLE_TIMEOUT = int(os.environ.get('QUERYX_CONNECTION_IDLE_SECONDS', '1800'))
+
+# Rows per page in the query result preview on the rules page
+PREVIEW_PAGE_SIZE = int(os.environ.get('QUERYX_PREVIEW_ROWS', '100'))
+
+# Download format -> (file extension, mimetype)
+EXPORT_FORMATS = {
+    'csv': ('.csv', 'text/csv'),
+    'parquet': ('.parquet', 'application/vnd.apache.parquet'),
+    'excel': ('.xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+# Rows fetched from DuckDB per batch while writing an Excel export
+EXPORT_BATCH_ROWS = 10000
+EXCEL_MAX_ROWS = 1048576
+
+# /api/query returns JSON pages of at most this many rows; Arrow IPC streams (when pyarrow
+# is installed) carry the whole result in record batches of EXPORT_BATCH_ROWS
+API_MAX_PAGE_ROWS = int(os.environ.get('QUERYX_API_MAX_PAGE_ROWS', '10000'))
+ARROW_STREAM_MIMETYPE = 'application/vnd.apache.arrow.stream'
+
+# Queries run as background jobs; each one is interrupted after QUERY_TIMEOUT seconds and its
+# result is kept as Parquet for JOB_RETENTION seconds so preview pages and downloads reuse it
+QUERY_TIMEOUT = float(os.environ.get('QUERYX_QUERY_TIMEOUT_SECONDS', '300'))
+QUERY_JOB_WORKERS = int(os.environ.get('QUERYX_QUERY_JOB_WORKERS', '4'))
+JOB_RETENTION = int(os.environ.get('QUERYX_JOB_RETENTION_SECONDS', '3600'))
+JOB_FOLDER = os.path.join(CACHE_FOLDER, 'jobs')
+os.makedirs(JOB_FOLDER, exist_ok=True)
+# Job and batch state is also kept as JSON under the cache folder, so any worker process can report
+# on, download or cancel them; other workers' jobs and cancel requests are checked this often
+JOB_POLL_SECONDS = 0.5
+# The worker running a job touches its state file every JOB_POLL_SECONDS. A job whose file has not
+# been touched for JOB_LOST_SECONDS, or that is still running JOB_LOST_SECONDS past the time limit,
+# lost its worker (killed or restarted) and is reported as failed, so it can be submitted again
+JOB_LOST_SECONDS = 30
+JOB_FINISHED_STATUSES = ('done', 'failed', 'cancelled', 'timeout')
+
+# Batch runs generate SQL for a list of rules in BATCH_LLM_WORKERS threads, sending at most
+# BATCH_LLM_RPM requests a minute to OpenAI, and run every query on one loaded connection
+BATCH_MAX_RULES = int(os.environ.get('QUERYX_BATCH_MAX_RULES', '500'))
+BATCH_LLM_WORKERS = int(os.environ.get('QUERYX_BATCH_LLM_WORKERS', '8'))
+BATCH_LLM_RPM = float(os.environ.get('QUERYX_BATCH_LLM_RPM', '60'))
+BATCH_LLM_RETRIES = 3
+BATCH_FOLDER = os.path.join(CACHE_FOLDER, 'batches')
+os.makedirs(BATCH_FOLDER, exist_ok=True)
+# Batch download format -> (file extension, mimetype); Parquet results come as a zip of files
+BATCH_EXPORT_FORMATS = {
+    'excel': EXPORT_FORMATS['excel'],
+    'parquet': ('.zip', 'application/zip'),
+}
+
+# Query results are cached as Parquet by dataset fingerprint and normalized SQL, so a
+# download right after a preview is served without touching the workbooks or DuckDB tables
+RESULT_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'results')
+os.makedirs(RESULT_CACHE_FOLDER, exist_ok=True)
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('QUERYX_RESULT_CACHE_MB', '1024')) * 1024 * 1024
+
+# LLM prompt history per session, kept server side so the cookie only carries an id
+HISTORY_PATH = os.path.join(CACHE_FOLDER, 'prompt_history.sqlite')
+HISTORY_PAGE_SIZE = 20
+
+LLM_MODEL = 'gpt-3.5-turbo'
+LLM_TEMPERATURE = 0.1
+# Identical generate/fix requests are answered from this cache instead of calling OpenAI again
+LLM_CACHE_PATH = os.path.join(CACHE_FOLDER, 'llm_cache.sqlite')
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get('QUERYX_LLM_CACHE_ENTRIES', '5000'))
+
+# Bumped whenever parsed sheets change shape, so older cached Parquet is not reused
+INGEST_VERSION = 4
+
+# Sheet reader backend: 'auto' uses calamine (Rust) when python-calamine is installed, else openpyxl
+EXCEL_READER = os.environ.get('QUERYX_EXCEL_READER', 'auto')
+
+# Sheets with more rows than this are streamed into DuckDB in batches instead of
+# being loaded into pandas whole, keeping memory bounded by the batch size
+STREAMING_ROW_THRESHOLD = int(os.environ.get('QUERYX_STREAMING_ROW_THRESHOLD', '200000'))
+STREAMING_BATCH_ROWS = int(os.environ.get('QUERYX_STREAMING_BATCH_ROWS', '50000'))
+STREAMING_MEMORY_LIMIT = os.environ.get('QUERYX_STREAMING_MEMORY_LIMIT', '512MB')
+
+# Sheets are parsed in this many worker processes; 1 parses inline in the request thread
+INGEST_WORKERS = int(os.environ.get('QUERYX_INGEST_WORKERS', str(os.cpu_count() or 1)))
+
+# Every ingested sheet is profiled once (type, nulls, distinct count, range, frequent values);
+# the profile is rendered into LLM prompts within QUERYX_PROMPT_SCHEMA_CHARS characters
+PROFILE_SAMPLE_VALUES = 3
+PROFILE_VALUE_CHARS = 40
+PROMPT_SCHEMA_CHARS = int(os.environ.get('QUERYX_PROMPT_SCHEMA_CHARS', '6000'))
+
+# With automatic fixing on, generated SQL that fails EXPLAIN is sent back to the model with
+# the DuckDB error up to this many times before anything runs on the data
+AUTO_FIX_ATTEMPTS = int(os.environ.get('QUERYX_AUTO_FIX_ATTEMPTS', '3'))
+
+# Request phases, ingestion, query jobs and downloads are timed and counted in process and served
+# in Prometheus text format at /metrics; every worker process reports its own values
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Append each page's phase timings as a footer and a Server-Timing header
+TIMING_FOOTER = os.environ.get('QUERYX_TIMING_FOOTER', '').lower() in ('1', 'true', 'yes')
+
 # Add a global style for all templates
 base_style = ''
 
@@ -108,30 +248,48 @@ def upload():
 			return render_template('upload.html')
 		
 		filepaths = []
-		for f in files:
-			if f and f.filename and f.filename != '':  # Make sure file is valid
-				print(f"Processing file: {f.filename}")
-				path = os.path.join(UPLOAD_FOLDER, f.filename)
-				f.save(path)
-				filepaths.append(path)
+		with phase_timer('save'):
+			for f in files:
+				if f and upload_filename(f.filename):  # Make sure file is valid
+					print(f"Processing file: {f.filename}")
+					try:
+						path = save_upload(f)
+					except UploadTooLarge as e:
+						return upload_error(str(e))
+					filepaths.append(path)
 		
 		print(f"Valid files processed: {len(filepaths)}")
 		
 		if len(filepaths) == 0:
 			print("No valid files found")
-			return render_template('upload.html')
+			return render_template('upload.html', max_file_mb=MAX_FILE_BYTES // (1024 * 1024))
 			
 		session['filepaths'] = filepaths
+		remember_datasets(filepaths)
+		if EAGER_INGEST:
+			submit_prepare_dataset(filepaths)
 		print("Redirecting to mapping page")
 		return redirect(url_for('mapping'))
 	
 	print("GET request - showing upload page")
-	return render_template('upload.html')
+	return render_template('upload.html', max_file_mb=MAX_FILE_BYTES // (1024 * 1024))
+
+def upload_error(message):
+	return render_template('upload.html', error=message, max_file_mb=MAX_FILE_BYTES // (1024 * 1024)), 413
+
+@app.errorhandler(413)
+def upload_too_large(e):
+	"""Werkzeug refuses request bodies over MAX_CONTENT_LENGTH before upload() sees them"""
+	message = f"Upload is larger than the {MAX_UPLOAD_BYTES // (1024 * 1024)} MB limit"
+	if request.path.startswith('/api/'):
+		return jsonify(error=message), 413
+	return upload_error(message)
 
 @app.route('/mapping', methods=['GET', 'POST'])
 def mapping():
     filepaths = session.get('filepaths', [])
-    excel_data = get_excel_data(filepaths)
+    with phase_timer('scan'):
+        excel_data = get_excel_data(filepaths)
     
     if request.method == 'POST':
         mapping = {}
@@ -157,66 +315,33 @@ def rules():
     prompt = ''
     error = ''
     api_key = ''
+    job_id = None
     
-    # Initialize LLM prompts in session if not exists
-    if 'llm_prompts' not in session:
-        session['llm_prompts'] = []
+    # Prompt history lives in the server-side store; drop the copy older versions kept in the cookie
+    session.pop('llm_prompts', None)
     
     # Check for download errors from previous attempts
     download_error = session.pop('download_error', None)
     if download_error:
         error = download_error
+    batch_error = session.pop('batch_error', None)
+    if batch_error:
+        error = batch_error
     filepaths = session.get('filepaths', [])
     mapping = session.get('mapping', None)
-    file_path_map = {os.path.basename(fp): fp for fp in filepaths}
     duckdb_tables = []
     duckdb_columns = {}
-    con = duckdb.connect()
+    pooled = None
     try:
-        if mapping:
-            # Use mapped table and column names
-            for key, mapinfo in mapping.items():
-                table_name = re.sub(r'[^a-zA-Z0-9_]', '', mapinfo['table'].replace(' ', '_').replace('-', '_')).lower()
-                filename, sheet = key.split('::')
-                file_path = file_path_map[filename]
-                xls = pd.ExcelFile(file_path)
-                df = xls.parse(sheet)
-                # Rename columns according to mapping
-                col_map = {col['original']: col['safe'] for col in mapinfo['columns']}
-                df = df.rename(columns=col_map)
-                con.execute(f"CREATE TABLE {table_name} AS SELECT * FROM df")
-                duckdb_tables.append(table_name)
-                # Store both original and sanitized column names as pairs
-                column_pairs = []
-                for col in mapinfo['columns']:
-                    column_pairs.append({'original': col['original'], 'sanitized': col['safe']})
-                duckdb_columns[table_name] = column_pairs
-        else:
-            # Fallback to original sheet/column names
-            for path in filepaths:
-                xls = pd.ExcelFile(path)
-                for sheet in xls.sheet_names:
-                    df = xls.parse(sheet)
-                    safe_sheet = re.sub(r'[^a-zA-Z0-9_]', '', sheet.replace(' ', '_').replace('-', '_')).lower()
-                    con.execute(f"CREATE TABLE {safe_sheet} AS SELECT * FROM df")
-                    duckdb_tables.append(safe_sheet)
-                    # Store both original and sanitized column names as pairs
-                    column_pairs = []
-                    for col in df.columns:
-                        safe_col = re.sub(r'[^a-zA-Z0-9_]', '', str(col).replace(' ', '_').replace('-', '_')).lower()
-                        column_pairs.append({'original': col, 'sanitized': safe_col})
-                    duckdb_columns[safe_sheet] = column_pairs
-        schema = []
-        for tname in duckdb_tables:
-            col_strs = []
-            for col_pair in duckdb_columns[tname]:
-                col_strs.append(f"{col_pair['sanitized']}")
-            schema.append(f"Table: {tname}\n  Columns: " + ', '.join(col_strs))
-        schema_str = '\n'.join(schema)
+        with phase_timer('load'):
+            pooled, con, duckdb_columns = acquire_dataset(filepaths, mapping)
+        duckdb_tables = list(duckdb_columns)
+        schema_str = schema_description(duckdb_columns)
     except Exception as e:
         error = f"Error loading Excel files: {e}"
         duckdb_columns = {}
         schema_str = ''
+        con = duckdb.connect()
 
     rule_text = ''
     if request.method == 'POST':
@@ -226,6 +351,7 @@ def rules():
             sql = request.form.get('sql', None)
             test_error = request.form.get('test_error', None)
             rule_text = request.form.get('rule_text', '')
+            auto_fix = request.form.get('auto_fix') == 'on'
             
             # Track tab context in session
             session['last_action'] = action
@@ -236,11 +362,15 @@ def rules():
             if action == 'write':
                 try:
                     if sql:
-                        sql_clean = re.sub(r'^```[a-zA-Z]*\s*', '', sql.strip())
-                        sql_clean = re.sub(r'```$', '', sql_clean.strip())
-                        result = con.execute(sql_clean).fetchdf()
-                        test_result = result.to_string()
-                        test_error = ''  # Clear error after successful run
+                        sql_clean = clean_sql(sql)
+                        # Invalid SQL is reported from EXPLAIN without touching the data
+                        test_error = validate_sql(con, sql_clean)
+                        if not test_error:
+                            # Run through the job queue so the time limit and cancel button apply
+                            job = query_job_for(request.form.get('job_id'), sql_clean, filepaths, mapping)
+                            job_id = job.id
+                            test_result = job_preview(job, request.form.get('page', 0, type=int))
+                            test_error = ''  # Clear error after successful run
                 except Exception as e:
                     test_error = str(e)
             else:
@@ -250,89 +380,55 @@ def rules():
                     error = 'Please enter your OpenAI API key.'
                 else:
                     openai.api_key = api_key
-                prompt = f"""
-You are an expert SQL developer. The target database is DuckDB (https://duckdb.org/), which is similar to PostgreSQL/SQLite but has its own quirks.
-
-Given the following table schema (actual loaded tables and columns):
-{schema_str}
-
-And the following rule description:
-{rule_text}
-
-Write a valid DuckDB SQL query for this rule. Output only the SQL code, nothing else.
-"""
+                prompt = rule_prompt(schema_str, rule_text)
                 if action == 'generate':
                     try:
-                        response = openai.chat.completions.create(
-                            model="gpt-3.5-turbo",
-                            messages=[
-                                {"role": "system", "content": "You are a helpful assistant that writes SQL queries for DuckDB."},
-                                {"role": "user", "content": prompt}
-                            ],
-                            max_tokens=512,
-                            temperature=0.1
-                        )
-                        sql_raw = response.choices[0].message.content.strip()
-                        # Remove markdown code block markers from LLM output
-                        sql = re.sub(r'^```[a-zA-Z]*\s*', '', sql_raw)
-                        sql = re.sub(r'```$', '', sql.strip())
-                        
-                        # Store the prompt in session
-                        prompt_data = {
-                            'timestamp': datetime.now().isoformat(),
-                            'type': 'SQL Generation',
-                            'prompt': prompt,
-                            'response': sql_raw,
-                            'model': 'gpt-3.5-turbo',
-                            'tokens': response.usage.total_tokens if hasattr(response, 'usage') else 'N/A',
-                            'rule_text': rule_text
-                        }
-                        session['llm_prompts'].append(prompt_data)
-                        session.modified = True  # Ensure session is saved
-                        
+                        sql, test_error = generate_sql(con, prompt, schema_str, rule_text, AUTO_FIX_ATTEMPTS if auto_fix else 0)
                     except Exception as e:
                         error = f"OpenAI API error: {e}"
+                    else:
+                        if auto_fix and not test_error:
+                            # Only SQL that passed validation is run on the data
+                            try:
+                                job = query_job_for(request.form.get('job_id'), sql, filepaths, mapping)
+                                job_id = job.id
+                                test_result = job_preview(job, request.form.get('page', 0, type=int))
+                            except Exception as e:
+                                test_error = str(e)
                 elif action == 'test':
                     try:
-                        sql_clean = sql
-                        if sql_clean:
-                            sql_clean = re.sub(r'^```[a-zA-Z]*\s*', '', sql_clean.strip())
-                            sql_clean = re.sub(r'```$', '', sql_clean.strip())
-                        result = con.execute(sql_clean).fetchdf()
-                        test_result = result.to_string()
-                        test_error = ''  # Clear error after successful run
+                        sql_clean = clean_sql(sql)
+                        # Invalid SQL is reported from EXPLAIN without touching the data
+                        test_error = validate_sql(con, sql_clean) if sql_clean else None
+                        if not test_error:
+                            # Run through the job queue so the time limit and cancel button apply
+                            job = query_job_for(request.form.get('job_id'), sql_clean, filepaths, mapping)
+                            job_id = job.id
+                            test_result = job_preview(job, request.form.get('page', 0, type=int))
+                            test_error = ''  # Clear error after successful run
                     except Exception as e:
                         test_error = str(e)
                 elif action == 'fix':
                     try:
-                        fix_prompt = prompt + f"\n\nDuckDB error: {test_error}\nPlease fix the SQL and output only the corrected SQL code."
-                        response = openai.chat.completions.create(
-                            model="gpt-3.5-turbo",
-                            messages=[
-                                {"role": "system", "content": "You are a helpful assistant that writes SQL queries for DuckDB."},
-                                {"role": "user", "content": fix_prompt}
-                            ],
-                            max_tokens=512,
-                            temperature=0.1
-                        )
-                        sql_raw = response.choices[0].message.content.strip()
+                        fix_prompt = sql_fix_prompt(prompt, sql, test_error)
+                        sql_raw, tokens, cached = complete_sql(fix_prompt, llm_cache_key('fix', schema_str, rule_text, sql, test_error))
                         # Remove markdown code block markers from LLM output
                         sql = re.sub(r'^```[a-zA-Z]*\s*', '', sql_raw)
                         sql = re.sub(r'```$', '', sql.strip())
                         
-                        # Store the fix prompt in session
+                        # Store the fix prompt in the history store
                         prompt_data = {
                             'timestamp': datetime.now().isoformat(),
                             'type': 'SQL Fix',
                             'prompt': fix_prompt,
                             'response': sql_raw,
-                            'model': 'gpt-3.5-turbo',
-                            'tokens': response.usage.total_tokens if hasattr(response, 'usage') else 'N/A',
+                            'model': LLM_MODEL,
+                            'tokens': tokens,
+                            'cached': cached,
                             'rule_text': rule_text,
                             'error': test_error
                         }
-                        session['llm_prompts'].append(prompt_data)
-                        session.modified = True  # Ensure session is saved
+                        record_prompt(prompt_data)
                         
                     except Exception as e:
                         error = f"OpenAI API error: {e}"
@@ -343,10 +439,15 @@ Write a valid DuckDB SQL query for this rule. Output only the SQL code, nothing
     if 'duckdb_columns' not in locals() or duckdb_columns is None:
         duckdb_columns = {}
     
-    # Get LLM prompts from session
-    llm_prompts = session.get('llm_prompts', [])
+    if pooled:
+        release_dataset(pooled, con)
+    
+    # Get the newest page of LLM prompts for this session
+    llm_prompts, history = prompt_history()
+    batch = get_batch(session.get('batch_id'))
         
-    return render_template('rules.html', 
+    with phase_timer('render'):
+        return render_template('rules.html', 
                          sql=sql, 
                          api_key=api_key, 
                          error=error, 
@@ -356,15 +457,257 @@ Write a valid DuckDB SQL query for this rule. Output only the SQL code, nothing
                          rule_text=rule_text, 
                          duckdb_columns=duckdb_columns,
                          llm_prompts=llm_prompts,
+                         history=history,
+                         job_id=job_id,
+                         auto_fix=auto_fix if request.method == 'POST' else True,
+                         batch=batch.to_dict() if batch else None,
                          request=request)
 
 @app.route('/clear_prompts', methods=['POST'])
 def clear_prompts():
     """Clear the LLM prompts history"""
-    session['llm_prompts'] = []
-    session.modified = True
+    with closing(history_db()) as db, db:
+        db.execute("DELETE FROM prompt_history WHERE session_id = ?", (history_session_id(),))
+    return redirect(url_for('rules'))
+
+@app.route('/prompt_history', methods=['GET'])
+def prompt_history_page():
+    """One page of the prompt history panel, swapped in by rules.html"""
+    llm_prompts, history = prompt_history(request.args.get('page', 0, type=int))
+    return render_template('prompt_history.html', llm_prompts=llm_prompts, history=history)
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Start a query in the background and return its job id"""
+    sql = clean_sql(request.form.get('sql') or (request.get_json(silent=True) or {}).get('sql'))
+    if not sql:
+        return jsonify(error='No SQL given'), 400
+    job = submit_query_job(sql, session.get('filepaths', []), session.get('mapping', None))
+    return jsonify(job.to_dict()), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify(error='Unknown job'), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify(error='Unknown job'), 404
+    job.cancel()
+    return jsonify(job.to_dict())
+
+@app.route('/batch', methods=['POST'])
+def submit_batch():
+    """Start generating and running SQL for a list of rules"""
+    api_key = request.form.get('api_key', '')
+    rule_list = parse_rule_list(request.form.get('rules', ''), request.files.get('rules_file'))
+    if not api_key:
+        session['batch_error'] = 'Please enter your OpenAI API key.'
+    elif not rule_list:
+        session['batch_error'] = 'Please enter at least one rule.'
+    elif len(rule_list) > BATCH_MAX_RULES:
+        session['batch_error'] = f"A batch can have at most {BATCH_MAX_RULES} rules; got {len(rule_list)}."
+    else:
+        openai.api_key = api_key
+        batch = submit_batch_run(rule_list, session.get('filepaths', []), session.get('mapping', None))
+        session['batch_id'] = batch.id
     return redirect(url_for('rules'))
 
+@app.route('/batch/<batch_id>', methods=['GET'])
+def batch_status(batch_id):
+    batch = get_batch(batch_id)
+    if batch is None:
+        return jsonify(error='Unknown batch'), 404
+    return jsonify(batch.to_dict())
+
+@app.route('/batch/<batch_id>/cancel', methods=['POST'])
+def cancel_batch(batch_id):
+    batch = get_batch(batch_id)
+    if batch is None:
+        return jsonify(error='Unknown batch'), 404
+    batch.cancel()
+    return jsonify(batch.to_dict())
+
+@app.route('/batch/<batch_id>/download', methods=['GET'])
+def download_batch(batch_id):
+    """One workbook (summary sheet plus a sheet per rule) or a zip of Parquet files"""
+    batch = get_batch(batch_id)
+    download_format = request.args.get('format', 'excel')
+    if download_format not in BATCH_EXPORT_FORMATS:
+        download_format = 'excel'
+    if batch is None or not batch.done.is_set():
+        session['batch_error'] = 'The batch has not finished yet.' if batch else 'Unknown batch.'
+        return redirect(url_for('rules'))
+    file_ext, mimetype = BATCH_EXPORT_FORMATS[download_format]
+    fd, temp_path = tempfile.mkstemp(suffix=file_ext)
+    os.close(fd)
+    try:
+        with phase_timer('export'):
+            export_batch(batch, download_format, temp_path)
+    except Exception as e:
+        remove_file(temp_path)
+        session['batch_error'] = f"Error downloading batch results: {str(e)}"
+        return redirect(url_for('rules'))
+    increment('queryx_export_bytes_total', os.path.getsize(temp_path), format=f'batch-{download_format}')
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return send_file(SelfDeletingFile(temp_path), mimetype=mimetype, as_attachment=True, download_name=f"batch_results_{timestamp}{file_ext}")
+
+@app.route('/api/datasets', methods=['GET'])
+def api_datasets():
+    """The workbooks this session uploaded, newest first"""
+    infos = [dataset_info(dataset_id) for dataset_id in session.get('dataset_ids', [])]
+    return jsonify(datasets=sorted((info for info in infos if info), key=lambda info: info['uploaded'], reverse=True))
+
+@app.route('/api/datasets', methods=['POST'])
+def api_upload():
+    """Store uploaded workbooks like the upload page does and return their dataset ids"""
+    filepaths = []
+    with phase_timer('save'):
+        for f in request.files.getlist('files'):
+            if f and upload_filename(f.filename):
+                try:
+                    filepaths.append(save_upload(f))
+                except UploadTooLarge as e:
+                    return jsonify(error=str(e)), 413
+    if not filepaths:
+        return jsonify(error='No files given'), 400
+    remember_datasets(filepaths)
+    if EAGER_INGEST:
+        submit_prepare_dataset(filepaths)
+    return jsonify(datasets=[dataset_info(os.path.basename(os.path.dirname(path))) for path in filepaths]), 201
+
+@app.route('/api/datasets/<dataset_id>', methods=['GET'])
+def api_dataset(dataset_id):
+    """One workbook with the tables and columns queries see, ingesting it if needed"""
+    info = dataset_info(dataset_id)
+    if info is None:
+        return jsonify(error=f'Unknown dataset {dataset_id}'), 404
+    try:
+        with phase_timer('load'), dataset_cursor(dataset_paths([dataset_id]), None) as (con, duckdb_columns):
+            info['tables'] = {table: [{'name': col['sanitized'], 'original': col['original'], 'profile': col['profile']} for col in columns]
+                              for table, columns in duckdb_columns.items()}
+    except Exception as e:
+        return jsonify(error=f"Error loading Excel files: {e}"), 422
+    return jsonify(info)
+
+@app.route('/api/query', methods=['POST'])
+def api_query():
+    """Run SQL on datasets and return one JSON page of the result, or all of it as an Arrow IPC stream.
+
+    Queries go through the job queue, so the time limit and the result cache apply;
+    pass the returned job_id with the next page to page through the stored result.
+    """
+    data = request.get_json(silent=True) or {}
+    sql = clean_sql(data.get('sql'))
+    output = data.get('format', 'json')
+    if not sql:
+        return jsonify(error='No SQL given'), 400
+    if output not in ('json', 'arrow'):
+        return jsonify(error=f'Unknown format {output}; use json or arrow'), 400
+    import importlib
+    if output == 'arrow' and importlib.util.find_spec('pyarrow') is None:
+        return jsonify(error='Arrow output requires pyarrow; install it or use format json'), 501
+    try:
+        filepaths = api_filepaths(data)
+        page = max(int(data.get('page') or 0), 0)
+        page_size = min(max(int(data.get('page_size') or PREVIEW_PAGE_SIZE), 1), API_MAX_PAGE_ROWS)
+    except LookupError as e:
+        return jsonify(error=str(e)), 404
+    except (TypeError, ValueError) as e:
+        return jsonify(error=str(e)), 400
+    job = query_job_for(data.get('job_id'), sql, filepaths, data.get('mapping'))
+    try:
+        result_sql = job_result_sql(job)
+    except QueryJobError:
+        return jsonify(job.to_dict()), 504 if job.status == 'timeout' else 400
+    if output == 'arrow':
+        increment('queryx_export_rows_total', job.total_rows or 0, format='arrow')
+        headers = {'X-QueryX-Job-Id': job.id, 'X-QueryX-Total-Rows': str(job.total_rows)}
+        return Response(arrow_stream(result_sql), mimetype=ARROW_STREAM_MIMETYPE, headers=headers)
+    with phase_timer('preview'), closing(duckdb.connect()) as con:
+        result = preview_query(con, result_sql, page, page_size)
+    result['rows'] = [[json_value(value) for value in row] for row in result['rows']]
+    return jsonify(dict(job.to_dict(), **result))
+
+@app.route('/api/generate', methods=['POST'])
+def api_generate():
+    """Generate SQL for a rule the way the rules page does, returning it with its validation result"""
+    data = request.get_json(silent=True) or {}
+    rule_text = (data.get('rule') or '').strip()
+    if not rule_text:
+        return jsonify(error='No rule given'), 400
+    if data.get('api_key'):
+        openai.api_key = data['api_key']
+    elif not (openai.api_key or os.environ.get('OPENAI_API_KEY')):
+        return jsonify(error='No OpenAI API key given'), 400
+    try:
+        filepaths = api_filepaths(data)
+    except LookupError as e:
+        return jsonify(error=str(e)), 404
+    auto_fix = data.get('auto_fix', True) is not False
+    try:
+        with phase_timer('load'):
+            pooled, con, duckdb_columns = acquire_dataset(filepaths, data.get('mapping'))
+    except Exception as e:
+        return jsonify(error=f"Error loading Excel files: {e}"), 422
+    try:
+        schema_str = schema_description(duckdb_columns)
+        sql, error = generate_sql(con, rule_prompt(schema_str, rule_text), schema_str, rule_text, AUTO_FIX_ATTEMPTS if auto_fix else 0)
+        if not auto_fix:
+            error = validate_sql(con, sql)
+    except Exception as e:
+        return jsonify(error=f"OpenAI API error: {e}"), 502
+    finally:
+        release_dataset(pooled, con)
+    return jsonify(sql=sql.strip(), valid=error is None, error=error)
+
+@app.route('/llm_cache', methods=['GET'])
+def llm_cache_info():
+    """Hit/miss counters and size of the LLM response cache"""
+    with closing(llm_cache_db()) as db:
+        entries = db.execute("SELECT count(*) FROM llm_cache").fetchone()[0]
+    return jsonify(hits=llm_cache_stats['hits'], misses=llm_cache_stats['misses'], entries=entries, max_entries=LLM_CACHE_MAX_ENTRIES)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text exposition of this process's timings and counters"""
+    response = make_response(render_metrics())
+    response.mimetype = 'text/plain'
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.phase_timings = []
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    seconds = time.perf_counter() - started
+    endpoint = request.endpoint or 'unknown'
+    observe('queryx_request_seconds', seconds, endpoint=endpoint)
+    increment('queryx_requests_total', endpoint=endpoint, status=str(response.status_code))
+    if TIMING_FOOTER:
+        timings = g.get('phase_timings', []) + [('total', seconds)]
+        response.headers['Server-Timing'] = ', '.join(f"{phase};dur={phase_seconds * 1000:.1f}" for phase, phase_seconds in timings)
+        if response.mimetype == 'text/html' and not response.direct_passthrough:
+            footer = '<div class="timing-footer" style="color:#94a3b8;font-size:12px;text-align:center;padding:10px;">' + \
+                ' · '.join(f"{phase} {phase_seconds * 1000:.0f} ms" for phase, phase_seconds in timings) + '</div>'
+            body = response.get_data(as_text=True)
+            if '</body>' in body:
+                body = body.replace('</body>', footer + '</body>', 1)
+            else:
+                body += footer
+            response.set_data(body)
+    return response
+
 @app.route('/download', methods=['POST'])
 def download_results():
     
@@ -374,115 +717,48 @@ def download_results():
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = f"{filename_base}_{timestamp}"
     
-    # Create a connection to DuckDB and execute the SQL
+    if download_format not in EXPORT_FORMATS:
+        download_format = 'csv'
+    temp_path = None
     try:
-        con = duckdb.connect()
-        # First recreate the tables that were in memory
-        filepaths = session.get('filepaths', [])
-        mapping = session.get('mapping', None)
-        file_path_map = {os.path.basename(fp): fp for fp in filepaths}
+        sql_clean = clean_sql(sql)
         
-        if mapping:
-            # Use mapped table and column names
-            for key, mapinfo in mapping.items():
-                table_name = re.sub(r'[^a-zA-Z0-9_]', '', mapinfo['table'].replace(' ', '_').replace('-', '_')).lower()
-                filename, sheet = key.split('::')
-                file_path = file_path_map[filename]
-                xls = pd.ExcelFile(file_path)
-                df = xls.parse(sheet)
-                # Rename columns according to mapping
-                col_map = {col['original']: col['safe'] for col in mapinfo['columns']}
-                df = df.rename(columns=col_map)
-                con.execute(f"CREATE TABLE IF NOT EXISTS {table_name} AS SELECT * FROM df")
-        else:
-            # Fallback to original sheet/column names
-            for path in filepaths:
-                xls = pd.ExcelFile(path)
-                for sheet in xls.sheet_names:
-                    df = xls.parse(sheet)
-                    safe_sheet = re.sub(r'[^a-zA-Z0-9_]', '', sheet.replace(' ', '_').replace('-', '_')).lower()
-                    con.execute(f"CREATE TABLE IF NOT EXISTS {safe_sheet} AS SELECT * FROM df")
+        if download_format == 'excel':
+            import importlib
+            if importlib.util.find_spec('openpyxl') is None:
+                # Fall back to CSV if openpyxl is not installed
+                download_format = 'csv'
+                session['download_error'] = "Excel export requires openpyxl. Falling back to CSV format."
         
-        # Clean the SQL
-        sql_clean = sql
-        if sql_clean:
-            sql_clean = re.sub(r'^```[a-zA-Z]*\s*', '', sql_clean.strip())
-            sql_clean = re.sub(r'```$', '', sql_clean.strip())
-            
-        # Execute the SQL and get the DataFrame
-        result_df = con.execute(sql_clean).fetchdf()
+        # Reuse the result of the query the user just previewed, or run it as a job
+        job = query_job_for(request.form.get('job_id'), sql_clean, session.get('filepaths', []), session.get('mapping', None))
+        result_sql = job_result_sql(job)
         
-        # Set appropriate file extension and mimetype
-        if download_format == 'csv':
-            file_ext = '.csv'
-            mimetype = 'text/csv'
-            download_name = f"{filename}.csv"
-        else:  # excel
-            file_ext = '.xlsx'
-            mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-            download_name = f"{filename}.xlsx"
-            
-        # Create a temporary file with the correct extension
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as temp_file:
-            temp_path = temp_file.name
-            
-        if download_format == 'csv':
-            # Save as CSV
-            result_df.to_csv(temp_path, index=False)
-        else:  # excel
+        file_ext, mimetype = EXPORT_FORMATS[download_format]
+        fd, temp_path = tempfile.mkstemp(suffix=file_ext)
+        os.close(fd)
+        
+        # Stream the stored result straight from DuckDB into the export file
+        with phase_timer('export'), closing(duckdb.connect()) as con:
             try:
-                # First check if openpyxl is available
-                import importlib
-                openpyxl_spec = importlib.util.find_spec('openpyxl')
-                
-                if openpyxl_spec is None:
-                    # openpyxl is not installed
-                    raise ImportError("openpyxl is not installed")
-                
-                # Try to use openpyxl engine
-                result_df.to_excel(temp_path, index=False, engine='openpyxl')
-                
-            except ImportError:
-                # Fall back to CSV if openpyxl is not installed
-                try:
-                    os.remove(temp_path)  # Remove the Excel file
-                except:
-                    pass  # Ignore if file doesn't exist
-                
-                # Create new temp file with CSV extension
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.csv') as csv_file:
-                    temp_path = csv_file.name
-                
-                result_df.to_csv(temp_path, index=False)
-                mimetype = 'text/csv'
-                download_name = f"{filename}.csv"
-                # Include note about missing dependency
-                session['download_error'] = "Excel export requires openpyxl. Falling back to CSV format."
-                
+                export_query(con, result_sql, download_format, temp_path)
             except Exception as e:
-                # Handle other Excel-related errors
-                try:
-                    os.remove(temp_path)  # Remove the Excel file
-                except:
-                    pass  # Ignore if file doesn't exist
-                
-                # Create new temp file with CSV extension
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.csv') as csv_file:
-                    temp_path = csv_file.name
-                
-                result_df.to_csv(temp_path, index=False)
-                mimetype = 'text/csv'
-                download_name = f"{filename}.csv"
-                # Include note about the error
-                session['download_error'] = f"Error creating Excel file: {str(e)}. Falling back to CSV format."
-                mimetype = 'text/csv'
-                download_name = f"{filename}.csv"
-                # Include note about the error
+                if download_format != 'excel':
+                    raise
+                # Handle Excel-related errors by falling back to CSV
                 session['download_error'] = f"Error creating Excel file: {str(e)}. Falling back to CSV format."
+                download_format = 'csv'
+                file_ext, mimetype = EXPORT_FORMATS[download_format]
+                export_query(con, result_sql, download_format, temp_path)
         
-        return send_file(temp_path, mimetype=mimetype, as_attachment=True, download_name=download_name)
+        increment('queryx_export_bytes_total', os.path.getsize(temp_path), format=download_format)
+        increment('queryx_export_rows_total', job.total_rows or 0, format=download_format)
+        # The export is streamed from disk and deleted once the server closes it
+        return send_file(SelfDeletingFile(temp_path), mimetype=mimetype, as_attachment=True, download_name=f"{filename}{file_ext}")
     
     except Exception as e:
+        if temp_path:
+            remove_file(temp_path)
         # If there's an error, redirect back to the rules page with an error message
         session['download_error'] = f"Error downloading results: {str(e)}"
         return redirect(url_for('rules'))
@@ -503,22 +779,1961 @@ def install_openpyxl():
     # Redirect back to the rules page
     return redirect(url_for('rules'))
 
+# Metric name -> (type, help text)
+METRICS = {
+    'queryx_request_seconds': ('histogram', 'Wall-clock time per request, by endpoint'),
+    'queryx_phase_seconds': ('histogram', 'Time spent in each phase of a request; load includes ingest and profile'),
+    'queryx_ingest_seconds': ('histogram', 'Time to parse one sheet (stage=parse) and write it to Parquet (stage=write), by reader'),
+    'queryx_query_seconds': ('histogram', 'Run time of background query jobs, by final status'),
+    'queryx_requests_total': ('counter', 'Requests by endpoint and status code'),
+    'queryx_upload_bytes_total': ('counter', 'Bytes of uploaded workbooks'),
+    'queryx_ingested_rows_total': ('counter', 'Rows parsed from workbook sheets'),
+    'queryx_query_rows_total': ('counter', 'Rows returned by background query jobs'),
+    'queryx_export_bytes_total': ('counter', 'Bytes of downloaded results, by format'),
+    'queryx_export_rows_total': ('counter', 'Rows of downloaded results, by format'),
+    'queryx_llm_requests_total': ('counter', 'LLM requests answered from the cache (result=hit) or the API (result=miss)'),
+    'queryx_llm_tokens_total': ('counter', 'Tokens used by OpenAI API requests'),
+    'queryx_pooled_connections': ('gauge', 'Upload sets loaded in the DuckDB connection pool'),
+    'queryx_pooled_connection_bytes': ('gauge', 'DuckDB memory held by pooled connections'),
+}
+
+# (name, sorted label items) -> counter value, or [cumulative bucket counts, sum, count] for histograms
+_metric_values = {}
+_metrics_lock = threading.Lock()
+
+def observe(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        histogram = _metric_values.setdefault(key, [[0] * len(METRIC_BUCKETS), 0.0, 0])
+        for i, bound in enumerate(METRIC_BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+def increment(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _metric_values[key] = _metric_values.get(key, 0) + amount
+
+@contextmanager
+def phase_timer(phase):
+    """Time a phase of the current request for /metrics and the timing footer.
+
+    Outside a request (background jobs and batches) the phase is recorded under endpoint="background".
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        in_request = has_request_context()
+        observe('queryx_phase_seconds', seconds, endpoint=(request.endpoint or 'unknown') if in_request else 'background', phase=phase)
+        if in_request and 'phase_timings' in g:
+            g.phase_timings.append((phase, seconds))
+
+def metric_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def metric_labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{metric_label_value(value)}"' for key, value in items) + '}'
+
+def render_metrics():
+    with _connections_lock:
+        gauges = {
+            ('queryx_pooled_connections', ()): len(_connections),
+            ('queryx_pooled_connection_bytes', ()): sum(entry.memory_bytes for entry in _connections.values()),
+        }
+    with _metrics_lock:
+        values = {key: [list(value[0]), value[1], value[2]] if isinstance(value, list) else value for key, value in _metric_values.items()}
+    values.update(gauges)
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for (key_name, labels), value in sorted(values.items()):
+            if key_name != name:
+                continue
+            if metric_type == 'histogram':
+                buckets, total, count = value
+                for bound, bucket_count in zip(METRIC_BUCKETS, buckets):
+                    lines.append(f'{name}_bucket{metric_labels(labels, le=f"{bound:g}")} {bucket_count}')
+                lines.append(f'{name}_bucket{metric_labels(labels, le="+Inf")} {count}')
+                lines.append(f'{name}_sum{metric_labels(labels)} {total:.6f}')
+                lines.append(f'{name}_count{metric_labels(labels)} {count}')
+            else:
+                lines.append(f'{name}{metric_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+def safe_name(name):
+    """Convert a sheet or column name to a database-safe identifier"""
+    return re.sub(r'[^a-zA-Z0-9_]', '', str(name).replace(' ', '_').replace('-', '_')).lower()
+
+def quote_ident(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+def quote_literal(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+# abspath -> (size, mtime_ns, sha256) so unchanged files are only hashed once
+_file_digests = {}
+_file_digests_lock = threading.Lock()
+
+def file_digest(path):
+    """Return the sha256 of a file's contents, dropping cached sheets of its previous contents"""
+    stat = os.stat(path)
+    abspath = os.path.abspath(path)
+    with _file_digests_lock:
+        known = _file_digests.get(abspath)
+    if known and known[:2] == (stat.st_size, stat.st_mtime_ns):
+        return known[2]
+    h = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _file_digests_lock:
+        _file_digests[abspath] = (stat.st_size, stat.st_mtime_ns, digest)
+        still_used = any(entry[2] == known[2] for entry in _file_digests.values()) if known else True
+    if not still_used:
+        # The uploaded bytes changed, so the old parse is stale
+        shutil.rmtree(os.path.join(CACHE_FOLDER, known[2]), ignore_errors=True)
+    return digest
+
+class UploadTooLarge(Exception):
+    """An uploaded file is over MAX_FILE_BYTES"""
+
+def upload_filename(name):
+    """The file name part of an uploaded file's name, or '' when there is none"""
+    name = os.path.basename((name or '').replace('\\', '/'))
+    return '' if name in ('.', '..') else name
+
+def save_upload(f):
+    """Stream an uploaded file to disk in chunks, hashing it on the way, and store it by content.
+
+    Returns uploads/<sha256>/<filename>. The same bytes uploaded again reuse the stored file,
+    or hard link to it under a new name, so they are only ingested once.
+    """
+    filename = upload_filename(f.filename)
+    temp_path = os.path.join(UPLOAD_FOLDER, f'.upload.{uuid.uuid4().hex}.tmp')
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with open(temp_path, 'wb') as out:
+            for chunk in iter(lambda: f.stream.read(UPLOAD_CHUNK_BYTES), b''):
+                size += len(chunk)
+                if size > MAX_FILE_BYTES:
+                    raise UploadTooLarge(f"{filename} is larger than the {MAX_FILE_BYTES // (1024 * 1024)} MB per-file limit")
+                h.update(chunk)
+                out.write(chunk)
+        digest = h.hexdigest()
+        folder = os.path.join(UPLOAD_FOLDER, digest)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, filename)
+        if not os.path.exists(path):
+            existing = [name for name in os.listdir(folder) if name != filename]
+            try:
+                if not existing:
+                    raise OSError('nothing to link to')
+                os.link(os.path.join(folder, existing[0]), path)
+            except OSError:
+                os.replace(temp_path, path)
+    finally:
+        remove_file(temp_path)
+    increment('queryx_upload_bytes_total', size)
+    remember_file_digest(path, digest)
+    return path
+
+def remember_file_digest(path, digest):
+    # The content hash is already known, so file_digest does not need to read the file again
+    stat = os.stat(path)
+    with _file_digests_lock:
+        _file_digests[os.path.abspath(path)] = (stat.st_size, stat.st_mtime_ns, digest)
+
+def dataset_paths(dataset_ids):
+    """Stored workbook path of each dataset id (an upload's content hash); raises LookupError for unknown ids"""
+    paths = []
+    for dataset_id in dataset_ids:
+        folder = os.path.join(UPLOAD_FOLDER, str(dataset_id))
+        names = sorted(os.listdir(folder)) if re.fullmatch(r'[0-9a-f]{64}', str(dataset_id)) and os.path.isdir(folder) else []
+        if not names:
+            raise LookupError(f'Unknown dataset {dataset_id}')
+        paths.append(os.path.join(folder, names[0]))
+        remember_file_digest(paths[-1], dataset_id)
+    return paths
+
+def remember_datasets(filepaths):
+    """Add uploaded workbooks to the ones GET /api/datasets lists for this session"""
+    dataset_ids = [os.path.basename(os.path.dirname(path)) for path in filepaths]
+    kept = [dataset_id for dataset_id in session.get('dataset_ids', []) if dataset_id not in dataset_ids]
+    session['dataset_ids'] = (kept + dataset_ids)[-SESSION_DATASETS:]
+
+def dataset_info(dataset_id):
+    """An uploaded workbook's names, size and ingestion state, or None for unknown ids"""
+    try:
+        path, = dataset_paths([dataset_id])
+    except LookupError:
+        return None
+    stat = os.stat(path)
+    return {
+        'id': dataset_id,
+        'files': sorted(os.listdir(os.path.dirname(path))),
+        'size_bytes': stat.st_size,
+        'uploaded': datetime.fromtimestamp(stat.st_mtime).isoformat(timespec='seconds'),
+        'ingested': os.path.exists(dataset_store_path(path)),
+    }
+
+def sheet_key(sheet):
+    return 's_' + hashlib.sha1(f'{INGEST_VERSION}:{sheet}'.encode('utf-8')).hexdigest()[:16]
+
+def sheet_cache_path(path, sheet):
+    return os.path.join(CACHE_FOLDER, file_digest(path), f'{sheet_key(sheet)}.parquet')
+
+def write_atomic_parquet(con, relation_sql, target):
+    # Write next to the target and rename, so readers never see a partial file
+    temp_path = f'{target}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        con.execute(f"COPY ({relation_sql}\n) TO {quote_literal(temp_path)} (FORMAT PARQUET)")
+    except Exception:
+        remove_file(temp_path)
+        raise
+    os.replace(temp_path, target)
+
+def parse_sheet(path, sheet, target, row_count=0):
+    """Parse one sheet into Parquet at target and return its timing.
+
+    Runs in the ingestion worker processes, so only the small timing dict is pickled back.
+    Sheets with more than STREAMING_ROW_THRESHOLD rows are streamed instead of loaded whole.
+    """
+    if row_count > STREAMING_ROW_THRESHOLD:
+        return stream_sheet(path, sheet, target)
+    started = time.perf_counter()
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    reader = excel_reader()
+    df = SHEET_READERS[reader](path, sheet)
+    df.columns = [str(col) for col in df.columns]
+    df = pin_column_types(df)
+    parsed = time.perf_counter()
+    con = duckdb.connect()
+    try:
+        con.register('df', df)
+        write_atomic_parquet(con, "SELECT * FROM df", target)
+    finally:
+        con.close()
+    return {
+        'file': os.path.basename(path),
+        'sheet': sheet,
+        'reader': reader,
+        'rows': len(df),
+        'parse_seconds': parsed - started,
+        'write_seconds': time.perf_counter() - parsed,
+    }
+
+def stream_sheet(path, sheet, target):
+    """Ingest a sheet too large for pandas in fixed-size batches.
+
+    Rows are read with openpyxl's read-only reader and appended STREAMING_BATCH_ROWS at a
+    time to a disk-backed DuckDB staging table, each cell as its text and its cell_kind().
+    Column types are then decided with one scan over the staged data and applied while
+    writing the Parquet file, so peak memory depends on the batch size, not on the sheet size.
+    """
+    import openpyxl
+    started = time.perf_counter()
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    staging_path = f'{target}.{os.getpid()}.{threading.get_ident()}.staging.duckdb'
+    con = duckdb.connect(staging_path)
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    rows = 0
+    try:
+        con.execute(f"SET memory_limit = {quote_literal(STREAMING_MEMORY_LIMIT)}")
+        row_iter = wb[sheet].iter_rows(values_only=True)
+        header = header_names(next(row_iter, ()))
+        width = len(header)
+        # Column i is staged as its text c<i> and cell kind k<i>
+        staged = [f'{part}{index}' for index in range(width) for part in 'ck']
+        con.execute(f"CREATE TABLE staging ({', '.join(f'{col} VARCHAR' for col in staged)})")
+        batch = []
+        for row in row_iter:
+            cells = [sheet_cell(value) for value in row[:width]]
+            if all(cell is None for cell in cells):
+                continue  # blank rows are dropped on both paths, see pin_column_types()
+            cells += [None] * (width - len(cells))
+            batch.append([part for cell in cells for part in ((None, None) if cell is None else (str(cell), cell_kind(cell)))])
+            if len(batch) >= STREAMING_BATCH_ROWS:
+                rows += append_batch(con, batch, staged)
+                batch = []
+        if batch:
+            rows += append_batch(con, batch, staged)
+        parsed = time.perf_counter()
+        select_list = ', '.join(f"{staged_column_cast(index, kind)} AS {quote_ident(col)}" for index, (col, kind) in enumerate(zip(header, staged_column_types(con, width))))
+        write_atomic_parquet(con, f"SELECT {select_list} FROM staging", target)
+    finally:
+        wb.close()
+        con.close()
+        remove_file(staging_path)
+        remove_file(f'{staging_path}.wal')
+    return {
+        'file': os.path.basename(path),
+        'sheet': sheet,
+        'reader': 'openpyxl-stream',
+        'rows': rows,
+        'parse_seconds': parsed - started,
+        'write_seconds': time.perf_counter() - parsed,
+    }
+
+def append_batch(con, batch, columns):
+    batch_df = pd.DataFrame(batch, columns=columns, dtype=object)
+    con.register('batch_df', batch_df)
+    con.execute("INSERT INTO staging SELECT * FROM batch_df")
+    con.unregister('batch_df')
+    return len(batch)
+
+def staged_column_types(con, width):
+    """column_type() for each staged column, with its counts taken in one scan over the staging table"""
+    checks = []
+    for index in range(width):
+        c, k = f'c{index}', f'k{index}'
+        numeric = f"{k} IN ('number', 'text')"
+        checks += [
+            f"count({c})",
+            f"count(*) FILTER (WHERE {k} = 'bool')",
+            f"count(*) FILTER (WHERE {k} = 'datetime')",
+            f"count(*) FILTER (WHERE {k} = 'number')",
+            f"count(*) FILTER (WHERE {k} = 'text')",
+            f"count(*) FILTER (WHERE {k} = 'text' AND regexp_full_match({c}, {quote_literal(ISO_DATE_PATTERN)}))",
+            f"count(*) FILTER (WHERE {numeric} AND NOT regexp_full_match({c}, {quote_literal(NUMBER_PATTERN)}))",
+            f"count(*) FILTER (WHERE {numeric} AND regexp_matches({c}, {quote_literal(CODE_PATTERN)}))",
+            f"count(*) FILTER (WHERE {numeric} AND regexp_full_match({c}, {quote_literal(NUMBER_PATTERN)}) "
+            f"AND (TRY_CAST({c} AS DOUBLE) % 1 <> 0 OR abs(TRY_CAST({c} AS DOUBLE)) >= {2 ** 53}))",
+        ]
+    counts = con.execute(f"SELECT {', '.join(checks)} FROM staging").fetchone()
+    size = len(COLUMN_FACTS)
+    return [column_type(dict(zip(COLUMN_FACTS, counts[index * size:(index + 1) * size]))) for index in range(width)]
+
+def staged_column_cast(index, kind):
+    c = f'c{index}'
+    if kind == 'BOOLEAN':
+        return f"({c} = 'True')"
+    if kind == 'BIGINT':
+        return f"CAST(CAST({c} AS DOUBLE) AS BIGINT)"
+    if kind == 'DOUBLE':
+        return f"CAST({c} AS DOUBLE)"
+    if kind == 'TIMESTAMP':
+        return f"TRY_CAST({c} AS TIMESTAMP)"
+    return c
+
+# Cells are read as objects and as stored, so pin_column_types sees what the streaming reader
+# sees; letting pandas infer numbers first would turn text codes like '00123' into 123, and its
+# default missing-value words would turn text such as 'NA' or 'null' into blanks
+def read_sheet_openpyxl(path, sheet):
+    return pd.read_excel(path, sheet_name=sheet, engine='openpyxl', dtype=object, keep_default_na=False)
+
+def read_sheet_calamine(path, sheet):
+    return pd.read_excel(path, sheet_name=sheet, engine='calamine', dtype=object, keep_default_na=False)
+
+# Reader name -> function(path, sheet) returning a DataFrame with the header row as columns
+SHEET_READERS = {
+    'calamine': read_sheet_calamine,
+    'openpyxl': read_sheet_openpyxl,
+}
+
+def excel_reader():
+    """Name of the sheet reader to use, preferring the native one when it is installed"""
+    if EXCEL_READER != 'auto':
+        return EXCEL_READER
+    import importlib
+    if importlib.util.find_spec('python_calamine') is not None:
+        return 'calamine'
+    return 'openpyxl'
+
+# Cell and column type rules shared by both ingestion paths: pin_column_types() applies them
+# in pandas and staged_column_types() in DuckDB, so a sheet gets the same rows and schema
+# whether or not it is streamed. The patterns are valid for both Python's re and DuckDB's RE2.
+NUMBER_PATTERN = r'\s*[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?\s*'
+# Codes like '00123' and long account numbers are identifiers, not numbers
+CODE_PATTERN = r'^\s*-?0[0-9]|[0-9]{16,}'
+ISO_DATE_PATTERN = r'[0-9]{4}-[0-9]{2}-[0-9]{2}([ T][0-9]{2}:[0-9]{2}(:[0-9]{2}(\.[0-9]+)?)?)?'
+NUMBER_RE, CODE_RE, ISO_DATE_RE = (re.compile(pattern, re.ASCII) for pattern in (NUMBER_PATTERN, CODE_PATTERN, ISO_DATE_PATTERN))
+# Formula errors; pandas reads them as missing, openpyxl's streaming reader as this text
+EXCEL_ERRORS = frozenset(('#NULL!', '#DIV/0!', '#VALUE!', '#REF!', '#NAME?', '#NUM!', '#N/A'))
+# Counts column_type() decides from, over a column's non-blank cells: all of them; those of each
+# cell_kind(); texts that are ISO dates; and numbers or texts that do not read as a number, that
+# look like codes, or that are not whole numbers below 2**53
+COLUMN_FACTS = ('cells', 'bools', 'datetimes', 'numbers', 'texts', 'iso_dates', 'not_numeric', 'code_like', 'fractional')
+
+def sheet_cell(value):
+    """A cell as both ingestion paths keep it: None for blanks and errors, whole floats as int"""
+    if isinstance(value, str):
+        return None if not value.strip() or value in EXCEL_ERRORS else value
+    if isinstance(value, float):
+        if math.isnan(value):
+            return None
+        # as pd.read_excel reads whole numbers, so both paths see the same digits
+        return int(value) if value.is_integer() else value
+    if value is None or value is pd.NaT or value is pd.NA:
+        return None
+    return value
+
+def cell_kind(value):
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, (datetime, date)):
+        return 'datetime'
+    if isinstance(value, (int, float, Decimal)):
+        return 'number'
+    if isinstance(value, str):
+        return 'text'
+    return 'other'  # times of day and the like, which are kept as text
+
+def column_type(facts):
+    """BOOLEAN, TIMESTAMP, BIGINT, DOUBLE or VARCHAR for a column, from its COLUMN_FACTS counts"""
+    cells = facts['cells']
+    if cells == 0:
+        return 'VARCHAR'
+    if facts['bools'] == cells:
+        return 'BOOLEAN'
+    if facts['datetimes'] == cells or facts['iso_dates'] == cells:
+        return 'TIMESTAMP'
+    if facts['numbers'] + facts['texts'] == cells and facts['not_numeric'] == 0 and facts['code_like'] == 0:
+        return 'DOUBLE' if facts['fractional'] else 'BIGINT'
+    return 'VARCHAR'
+
+def column_facts(cells):
+    """COLUMN_FACTS counts for a list of non-blank sheet_cell() values.
+
+    Only what column_type() compares is exact: the kind counts, whether iso_dates equals cells
+    and whether the number checks are zero. The scans stop once the answer is settled.
+    """
+    facts = dict.fromkeys(COLUMN_FACTS, 0)
+    facts['cells'] = len(cells)
+    for kind, count in Counter(map(cell_kind, cells)).items():
+        if kind != 'other':
+            facts[f'{kind}s'] = count
+    if facts['texts'] == len(cells) and all(ISO_DATE_RE.fullmatch(value) for value in cells):
+        facts['iso_dates'] = len(cells)
+    if facts['numbers'] + facts['texts'] == len(cells):
+        for value in cells:
+            if type(value) is int:
+                # str() of an int always reads as a whole number; only its length can make it a code
+                if abs(value) >= 10 ** 15:
+                    facts['code_like'] = 1
+                    break
+                continue
+            text = str(value)
+            if CODE_RE.search(text):
+                facts['code_like'] = 1
+                break
+            if not NUMBER_RE.fullmatch(text):
+                facts['not_numeric'] = 1
+                break
+            if float(text) % 1 or abs(float(text)) >= 2 ** 53:
+                facts['fractional'] = 1
+    return facts
+
+def pin_column_type(series):
+    """Return a column of sheet_cell() values converted to the type column_type() picks"""
+    kind = column_type(column_facts(series.dropna().tolist()))
+    if kind == 'BOOLEAN':
+        return series.astype('boolean')
+    # DataFrame.map() stores the blanks sheet_cell() returns as NaN
+    if kind == 'TIMESTAMP':
+        return pd.to_datetime(series.map(lambda value: None if pd.isna(value) else str(value)), format='ISO8601', errors='coerce')
+    if kind in ('BIGINT', 'DOUBLE'):
+        numbers = series.map(lambda value: None if pd.isna(value) else float(str(value))).astype('float64')
+        return numbers.astype('Int64') if kind == 'BIGINT' else numbers
+    if series.isna().all():
+        return pd.Series(None, index=series.index, dtype='string')
+    return series.map(lambda value: None if pd.isna(value) else str(value))
+
+def pin_column_types(df):
+    """Infer dates, integers and decimals once at ingestion so DuckDB stores typed columns.
+
+    Fully blank rows are dropped, as the streaming path does.
+    """
+    df = df.map(sheet_cell).dropna(how='all').reset_index(drop=True)
+    for col in df.columns:
+        df[col] = pin_column_type(df[col])
+    return df
+
+_ingest_pool = None
+_ingest_pool_lock = threading.Lock()
+
+def ingest_pool():
+    global _ingest_pool
+    with _ingest_pool_lock:
+        if _ingest_pool is None:
+            # spawn, not fork: forking a threaded server holding DuckDB handles is unsafe
+            _ingest_pool = ProcessPoolExecutor(max_workers=INGEST_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _ingest_pool
+
+def run_ingest_tasks(func, tasks):
+    """Run func(*task) for every task, across the worker pool when there is more than one"""
+    if INGEST_WORKERS > 1 and len(tasks) > 1:
+        pool = ingest_pool()
+        try:
+            futures = [pool.submit(func, *task) for task in tasks]
+            return [future.result() for future in futures]
+        except BrokenProcessPool:
+            # A worker process died (killed for running out of memory, say) and the pool refuses
+            # all further work; drop it so the next ingest starts a fresh one
+            reset_ingest_pool(pool)
+            raise
+    return [func(*task) for task in tasks]
+
+def reset_ingest_pool(pool):
+    global _ingest_pool
+    with _ingest_pool_lock:
+        if _ingest_pool is pool:
+            _ingest_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def ingest_sheets(sheets):
+    """Make sure every (path, sheet) is in the Parquet cache, parsing missing ones in parallel.
+
+    Returns {(path, sheet): parquet_path}.
+    """
+    targets = {(path, sheet): sheet_cache_path(path, sheet) for path, sheet in sheets}
+    missing = []
+    for (path, sheet), target in targets.items():
+        if not os.path.exists(target):
+            # The row count from the header scan decides whether the sheet is streamed
+            row_count = next((meta['row_count'] for meta in sheet_metadata(path) if meta['sheet'] == sheet), 0)
+            missing.append((path, sheet, target, row_count))
+    with phase_timer('ingest'):
+        timings = run_ingest_tasks(parse_sheet, missing)
+    for timing in timings:
+        print(f"Ingested {timing['file']}::{timing['sheet']} with {timing['reader']}: {timing['rows']} rows, "
+              f"parse {timing['parse_seconds']:.2f}s, parquet {timing['write_seconds']:.2f}s")
+        observe('queryx_ingest_seconds', timing['parse_seconds'], stage='parse', reader=timing['reader'])
+        observe('queryx_ingest_seconds', timing['write_seconds'], stage='write', reader=timing['reader'])
+        increment('queryx_ingested_rows_total', timing['rows'])
+    # Profile new sheets, and sheets cached before profiles existed
+    unprofiled = [(target,) for target in targets.values() if not os.path.exists(profile_path(target))]
+    with phase_timer('profile'):
+        run_ingest_tasks(profile_sheet, unprofiled)
+    return targets
+
+def profile_path(parquet_path):
+    return os.path.splitext(parquet_path)[0] + '.profile.json'
+
+def profile_value(value):
+    text = str(value)
+    if text.endswith(' 00:00:00'):
+        text = text[:-9]  # dates read from Excel are midnight timestamps
+    return text if len(text) <= PROFILE_VALUE_CHARS else text[:PROFILE_VALUE_CHARS - 1] + '…'
+
+def profile_sheet(parquet_path):
+    """Summarize every column of a cached sheet in one pass and store it next to the Parquet file.
+
+    Runs in the ingestion worker processes. Returns {column: {'type', 'null_pct', 'distinct',
+    'min', 'max', 'samples'}}. Numeric and temporal columns get min and max, text and boolean
+    columns their most frequent values instead.
+    """
+    source = f"read_parquet({quote_literal(parquet_path)})"
+    with closing(duckdb.connect()) as con:
+        cursor = con.execute(f"SUMMARIZE SELECT * FROM {source}")
+        fields = [col[0] for col in cursor.description]
+        summary = [dict(zip(fields, row)) for row in cursor.fetchall()]
+        samples = []
+        if summary:
+            sample_list = ', '.join(f"approx_top_k({quote_ident(col['column_name'])}, {PROFILE_SAMPLE_VALUES})" for col in summary)
+            samples = con.execute(f"SELECT {sample_list} FROM {source}").fetchone()
+    profile = {}
+    for col, top in zip(summary, samples):
+        col_type = col['column_type']
+        ranged = col_type not in ('VARCHAR', 'BOOLEAN') and col['min'] is not None
+        profile[col['column_name']] = {
+            'type': col_type,
+            'null_pct': float(col['null_percentage'] or 0),
+            'distinct': col['approx_unique'],
+            'min': profile_value(col['min']) if ranged else None,
+            'max': profile_value(col['max']) if ranged else None,
+            'samples': [] if ranged else [profile_value(value) for value in top or [] if value is not None],
+        }
+    target = profile_path(parquet_path)
+    temp_path = f'{target}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'w') as fh:
+        json.dump(profile, fh)
+    os.replace(temp_path, target)
+    return profile
+
+def sheet_profile(parquet_path):
+    try:
+        with open(profile_path(parquet_path)) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+def dataset_store_path(path):
+    return os.path.join(CACHE_FOLDER, file_digest(path), f'dataset_v{INGEST_VERSION}.duckdb')
+
+# Without fcntl the store lock falls back to one thread lock per workbook digest
+_store_thread_locks = {}
+_store_thread_locks_lock = threading.Lock()
+
+@contextmanager
+def store_lock(digest):
+    """Hold the exclusive lock on one workbook's dataset store, across all worker processes.
+
+    Each acquisition opens the lock file anew, so flock also excludes other threads of this process.
+    """
+    if fcntl is None:
+        with _store_thread_locks_lock:
+            lock = _store_thread_locks.setdefault(digest, threading.Lock())
+        with lock:
+            yield
+        return
+    lock_path = os.path.join(CACHE_FOLDER, digest, 'store.lock')
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, 'a') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+def build_dataset_stores(filepaths):
+    """Make sure every workbook has its DuckDB store file, building missing ones exactly once.
+
+    The worker that takes a workbook's lock first parses its sheets and writes the store;
+    others wait on the lock and then find the finished file. Returns {path: store path}.
+    """
+    stores = {path: dataset_store_path(path) for path in filepaths}
+    # Upload names that share their bytes share one store, so each digest is locked and built once
+    missing = {}
+    for path in filepaths:
+        if not os.path.exists(stores[path]):
+            missing.setdefault(file_digest(path), path)
+    if not missing:
+        return stores
+    with ExitStack() as locks:
+        # Always lock in the same order so two workers cannot deadlock
+        for digest in sorted(missing):
+            locks.enter_context(store_lock(digest))
+        missing = [path for digest, path in sorted(missing.items()) if not os.path.exists(stores[path])]
+        sheets = [(path, meta['sheet']) for path in missing for meta in sheet_metadata(path)]
+        parquet_paths = ingest_sheets(sheets)
+        with phase_timer('store'):
+            for path in missing:
+                temp_path = f'{stores[path]}.{os.getpid()}.tmp'
+                remove_file(temp_path)
+                try:
+                    with closing(duckdb.connect(temp_path)) as con:
+                        for meta in sheet_metadata(path):
+                            con.execute(f"CREATE TABLE {sheet_key(meta['sheet'])} AS SELECT * FROM read_parquet({quote_literal(parquet_paths[(path, meta['sheet'])])})")
+                except Exception:
+                    remove_file(temp_path)
+                    raise
+                os.replace(temp_path, stores[path])
+                # The store now holds the data; profiles stay next to where the Parquet files were
+                for meta in sheet_metadata(path):
+                    remove_file(parquet_paths[(path, meta['sheet'])])
+    return stores
+
+# Uploads are scanned and ingested here when EAGER_INGEST is on
+_prepare_executor = ThreadPoolExecutor(max_workers=2)
+# Workbook digest -> Future of its background header scan, which the mapping page waits for
+_pending_scans = {}
+_pending_scans_lock = threading.Lock()
+
+def submit_prepare_dataset(filepaths):
+    """Scan and ingest freshly uploaded workbooks in the background, ahead of the mapping and rules pages"""
+    scan = _prepare_executor.submit(scan_workbooks, filepaths)
+    digests = [file_digest(path) for path in filepaths]
+    with _pending_scans_lock:
+        for digest in digests:
+            _pending_scans[digest] = scan
+    scan.add_done_callback(lambda _: forget_pending_scans(digests, scan))
+    _prepare_executor.submit(prepare_dataset, filepaths, scan)
+
+def forget_pending_scans(digests, scan):
+    with _pending_scans_lock:
+        for digest in digests:
+            if _pending_scans.get(digest) is scan:
+                del _pending_scans[digest]
+
+def wait_for_pending_scans(filepaths):
+    with _pending_scans_lock:
+        scans = {_pending_scans.get(file_digest(path)) for path in filepaths} - {None}
+    for scan in scans:
+        try:
+            scan.result()
+        except Exception:
+            pass  # The caller scans again and reports the error
+
+def prepare_dataset(filepaths, scan):
+    """Build the dataset stores once the header scan is done.
+
+    The store lock makes a request that arrives meanwhile wait for this build instead of
+    starting its own; failures are only logged, since /rules hits and reports them again.
+    """
+    try:
+        scan.result()
+        build_dataset_stores(filepaths)
+    except Exception as e:
+        print(f"Background ingestion of {', '.join(os.path.basename(p) for p in filepaths)} failed: {e}")
+
+def load_raw_tables(con, filepaths):
+    """Attach every workbook's dataset store read-only, building stores that do not exist yet.
+
+    Returns {(basename, sheet): {'table': qualified table name, 'profile': {column: profile}}}.
+    """
+    stores = build_dataset_stores(filepaths)
+    raw_tables = {}
+    for path in filepaths:
+        alias = 'f_' + file_digest(path)[:16]
+        # Tables are read from the file through DuckDB's buffer manager rather than copied into memory
+        con.execute(f"ATTACH IF NOT EXISTS {quote_literal(stores[path])} AS {alias} (READ_ONLY)")
+        for meta in sheet_metadata(path):
+            raw_tables[(os.path.basename(path), meta['sheet'])] = {
+                'table': f"{alias}.{sheet_key(meta['sheet'])}",
+                'profile': sheet_profile(sheet_cache_path(path, meta['sheet'])),
+            }
+    return raw_tables
+
+def create_mapping_views(con, schema, mapping, raw_tables):
+    """Expose the raw tables under the mapping's table and column names as views in schema.
+
+    Returns {table_name: [{'original': ..., 'sanitized': ..., 'profile': ...}, ...]} in load order,
+    where profile is the column's ingestion profile or None.
+    """
+    con.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+    duckdb_columns = {}
+    if mapping:
+        # Use mapped table and column names
+        for key, mapinfo in mapping.items():
+            table_name = safe_name(mapinfo['table'])
+            if table_name in duckdb_columns:
+                continue
+            filename, sheet = key.split('::')
+            raw_name = raw_tables[(filename, sheet)]['table']
+            profile = raw_tables[(filename, sheet)]['profile']
+            # Rename columns according to mapping
+            col_map = {col['original']: col['safe'] for col in mapinfo['columns']}
+            raw_cols = [row[0] for row in con.execute(f"DESCRIBE {raw_name}").fetchall()]
+            select_list = ', '.join(f"{quote_ident(col)} AS {quote_ident(col_map.get(col, col))}" for col in raw_cols)
+            con.execute(f"CREATE OR REPLACE VIEW {schema}.{table_name} AS SELECT {select_list} FROM {raw_name}")
+            # Store both original and sanitized column names as pairs
+            duckdb_columns[table_name] = [{'original': col['original'], 'sanitized': col['safe'], 'profile': profile.get(col['original'])} for col in mapinfo['columns']]
+    else:
+        # Fallback to original sheet/column names
+        for (filename, sheet), raw in raw_tables.items():
+            table_name = safe_name(sheet)
+            if table_name in duckdb_columns:
+                continue
+            con.execute(f"CREATE OR REPLACE VIEW {schema}.{table_name} AS SELECT * FROM {raw['table']}")
+            raw_cols = [row[0] for row in con.execute(f"DESCRIBE {raw['table']}").fetchall()]
+            duckdb_columns[table_name] = [{'original': col, 'sanitized': col, 'profile': raw['profile'].get(col)} for col in raw_cols]
+    return duckdb_columns
+
+class PooledConnection:
+    """A DuckDB connection with an upload set's dataset stores attached, shared across requests.
+
+    Each mapping of the upload set gets its own schema of views over the stored tables, so
+    editing the mapping only creates views and never reloads the data.
+    """
+
+    def __init__(self, key, con, raw_tables):
+        self.key = key
+        self.con = con
+        self.raw_tables = raw_tables
+        self.mappings = {}  # mapping key -> (schema name, duckdb_columns)
+        self.lock = threading.Lock()
+        self.memory_bytes = 0
+        self.last_used = time.time()
+        self.in_use = 0
+
+# upload set key -> PooledConnection, least recently used first
+_connections = OrderedDict()
+_connections_lock = threading.Lock()
+
+def dataset_key(filepaths, mapping):
+    """Fingerprint of the uploaded file contents plus the mapping applied to them"""
+    payload = json.dumps({'version': INGEST_VERSION, 'files': [[os.path.basename(p), file_digest(p)] for p in filepaths], 'mapping': mapping}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def connection_memory(con):
+    try:
+        return con.execute("SELECT coalesce(sum(memory_usage_bytes), 0) FROM duckdb_memory()").fetchone()[0]
+    except duckdb.Error:
+        return 0
+
+def evict_connections():
+    """Close idle connections past the timeout, then LRU ones until under the memory budget.
+
+    Must be called with _connections_lock held. Connections in use are never closed.
+    """
+    now = time.time()
+    for key, entry in list(_connections.items()):
+        if entry.in_use == 0 and now - entry.last_used > CONNECTION_IDLE_TIMEOUT:
+            del _connections[key]
+            entry.con.close()
+    total = sum(entry.memory_bytes for entry in _connections.values())
+    for key, entry in list(_connections.items()):
+        if total <= CONNECTION_MEMORY_BUDGET:
+            break
+        if entry.in_use == 0:
+            del _connections[key]
+            entry.con.close()
+            total -= entry.memory_bytes
+
+def mapping_views(entry, filepaths, mapping):
+    """Return (schema, duckdb_columns) for a mapping, creating its views on first use"""
+    mapping_key = hashlib.sha256(json.dumps(mapping, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    with entry.lock:
+        if mapping_key not in entry.mappings:
+            schema = f'm_{mapping_key}'
+            with closing(entry.con.cursor()) as cur:
+                duckdb_columns = create_mapping_views(cur, schema, mapping, entry.raw_tables)
+            entry.mappings[mapping_key] = (schema, duckdb_columns)
+        return entry.mappings[mapping_key]
+
+def acquire_dataset(filepaths, mapping):
+    """Return (pooled connection, cursor, duckdb_columns) for the session's tables.
+
+    The dataset stores are attached on first use of an upload set and the cursor's search_path
+    points at the mapping's views. Each caller gets its own cursor, so concurrent requests
+    can share one database. Pair every call with release_dataset().
+    """
+    key = dataset_key(filepaths, None)
+    with _connections_lock:
+        entry = _connections.get(key)
+        if entry:
+            _connections.move_to_end(key)
+            entry.in_use += 1
+    if entry is None:
+        con = duckdb.connect()
+        try:
+            raw_tables = load_raw_tables(con, filepaths)
+        except Exception:
+            con.close()
+            raise
+        with _connections_lock:
+            entry = _connections.get(key)
+            if entry:
+                # Another request loaded the same upload set meanwhile
+                con.close()
+                _connections.move_to_end(key)
+            else:
+                entry = PooledConnection(key, con, raw_tables)
+                entry.memory_bytes = connection_memory(con)
+                _connections[key] = entry
+                start_watcher()
+            entry.in_use += 1
+            evict_connections()
+    try:
+        schema, duckdb_columns = mapping_views(entry, filepaths, mapping)
+        cursor = entry.con.cursor()
+        cursor.execute(f"SET search_path = {quote_literal(schema)}")
+    except Exception:
+        with _connections_lock:
+            entry.in_use -= 1
+        raise
+    return entry, cursor, duckdb_columns
+
+def release_dataset(entry, cursor):
+    # Queries grow the buffer pool over the attached stores, so the budget needs a fresh reading
+    memory_bytes = connection_memory(cursor)
+    cursor.close()
+    with _connections_lock:
+        entry.memory_bytes = memory_bytes or entry.memory_bytes
+        entry.in_use -= 1
+        entry.last_used = time.time()
+        evict_connections()
+
+@contextmanager
+def scratch_dataset(filepaths, mapping):
+    """Yield (connection, duckdb_columns) on a private in-memory database over the dataset stores.
+
+    Statements that may change the database run here instead of on the pooled connection,
+    so nothing they create, drop or set reaches other sessions; it is all gone on close.
+    """
+    with closing(duckdb.connect()) as con:
+        duckdb_columns = create_mapping_views(con, 'dataset', mapping, load_raw_tables(con, filepaths))
+        con.execute("SET search_path = 'dataset'")
+        yield con, duckdb_columns
+
+@contextmanager
+def dataset_cursor(filepaths, mapping):
+    """Yield (cursor, duckdb_columns) for a dataset from the connection pool"""
+    entry, cursor, duckdb_columns = acquire_dataset(filepaths, mapping)
+    try:
+        yield cursor, duckdb_columns
+    finally:
+        release_dataset(entry, cursor)
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass  # Ignore if file doesn't exist
+
+class SelfDeletingFile(io.FileIO):
+    """A read-only temp file that removes itself when closed after being sent"""
+
+    def __init__(self, path):
+        super().__init__(path, 'rb')
+
+    def close(self):
+        super().close()
+        remove_file(self.name)
+
+def excel_value(value):
+    """Coerce a DuckDB value to something openpyxl can write"""
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.replace(tzinfo=None)  # Excel has no time zones
+    if value is None or isinstance(value, (str, int, float, bool, Decimal, date, dt_time, datetime, timedelta)):
+        return value
+    return str(value)
+
+def export_query(con, sql, download_format, path):
+    """Write a query's result to path without loading it into pandas.
+
+    CSV and Parquet are written by DuckDB itself; Excel goes through openpyxl's
+    write-only workbook in batches of EXPORT_BATCH_ROWS, so memory stays flat.
+    """
+    if download_format == 'csv':
+        con.execute(f"COPY ({sql}\n) TO {quote_literal(path)} (FORMAT CSV, HEADER)")
+    elif download_format == 'parquet':
+        con.execute(f"COPY ({sql}\n) TO {quote_literal(path)} (FORMAT PARQUET)")
+    else:
+        import openpyxl
+        wb = openpyxl.Workbook(write_only=True)
+        write_excel_sheet(wb, 'Results', con.execute(sql))
+        wb.save(path)
+
+def write_excel_sheet(wb, title, cursor):
+    """Append a cursor's rows to a write-only workbook as sheet title, fetching in batches.
+
+    Rows beyond Excel's limit continue on sheets named "title 2", "title 3" and so on.
+    """
+    header = [col[0] for col in cursor.description or []]
+    ws = wb.create_sheet(title)
+    ws.append(header)
+    sheet_rows = 1
+    part = 1
+    while True:
+        batch = cursor.fetchmany(EXPORT_BATCH_ROWS)
+        if not batch:
+            break
+        for row in batch:
+            if sheet_rows >= EXCEL_MAX_ROWS:
+                # Continue on another sheet once Excel's row limit is reached
+                part += 1
+                ws = wb.create_sheet(f'{title} {part}')
+                ws.append(header)
+                sheet_rows = 1
+            ws.append([excel_value(value) for value in row])
+            sheet_rows += 1
+
+def preview_query(con, sql, page=0, page_size=None):
+    """Fetch one page of a query's result and its total row count.
+
+    Only page_size rows are ever materialized, however large the result is.
+    """
+    page_size = page_size or PREVIEW_PAGE_SIZE
+    page = max(page, 0)
+    sql_body = sql.strip().rstrip(';')
+    try:
+        total_rows = con.execute(f"SELECT count(*) FROM ({sql_body}\n)").fetchone()[0]
+        cursor = con.execute(f"SELECT * FROM ({sql_body}\n) LIMIT {page_size} OFFSET {page * page_size}")
+        rows = cursor.fetchall()
+    except duckdb.ParserException:
+        # Not a plain query (PRAGMA, SHOW, DDL...), so run it as is and page through the cursor
+        total_rows = None
+        cursor = con.execute(sql_body)
+        rows = []
+        if cursor.description:
+            if page:
+                cursor.fetchmany(page * page_size)
+            rows = cursor.fetchmany(page_size)
+    columns = [col[0] for col in cursor.description] if cursor.description else []
+    if total_rows is None:
+        has_next = len(rows) == page_size
+    else:
+        has_next = (page + 1) * page_size < total_rows
+    return {
+        'columns': columns,
+        'rows': rows,
+        'total_rows': total_rows,
+        'page': page,
+        'page_size': page_size,
+        'first_row': page * page_size + 1 if rows else 0,
+        'last_row': page * page_size + len(rows),
+        'has_next': has_next,
+    }
+
+def column_profile_text(profile, detail=3):
+    """Describe a column profile in a few words; lower detail drops samples, then the range"""
+    if not profile:
+        return ''
+    parts = []
+    if profile['null_pct']:
+        parts.append(f"{profile['null_pct']:.0f}% null")
+    if detail >= 2:
+        parts.append(f"~{profile['distinct']} distinct")
+        if profile['min'] is not None:
+            parts.append(f"{profile['min']}..{profile['max']}")
+    if detail >= 3 and profile['samples']:
+        parts.append('e.g. ' + ', '.join(quote_literal(value) for value in profile['samples']))
+    return profile['type'] + (f" [{'; '.join(parts)}]" if parts else '')
+
+def schema_description(duckdb_columns, max_chars=None):
+    """The loaded tables and columns with their profiles, as given to the model.
+
+    Detail is reduced step by step until the text fits in max_chars; at the lowest
+    level only table and column names are left.
+    """
+    max_chars = max_chars or PROMPT_SCHEMA_CHARS
+    for detail in (3, 2, 1, 0):
+        schema = []
+        for tname, columns in duckdb_columns.items():
+            col_strs = []
+            for col_pair in columns:
+                profile_text = column_profile_text(col_pair.get('profile'), detail) if detail else ''
+                col_strs.append(f"{col_pair['sanitized']} {profile_text}".strip())
+            schema.append(f"Table: {tname}\n  Columns: " + ', '.join(col_strs))
+        schema_str = '\n'.join(schema)
+        if len(schema_str) <= max_chars:
+            break
+    return schema_str
+
+def rule_prompt(schema_str, rule_text):
+    return f"""
+You are an expert SQL developer. The target database is DuckDB (https://duckdb.org/), which is similar to PostgreSQL/SQLite but has its own quirks.
+
+Given the following table schema (actual loaded tables and columns):
+{schema_str}
+
+And the following rule description:
+{rule_text}
+
+Write a valid DuckDB SQL query for this rule. Output only the SQL code, nothing else.
+"""
+
+def sql_fix_prompt(prompt, sql, error):
+    return prompt + f"\n\nPrevious SQL:\n{sql}\n\nDuckDB error: {error}\nPlease fix the SQL and output only the corrected SQL code."
+
+def is_query_statement(statement):
+    # PRAGMAs that return rows parse as SELECT too, but cannot be planned or wrapped like queries
+    return statement.type == duckdb.StatementType.SELECT and not re.match(r'\s*PRAGMA\b', statement.query, re.IGNORECASE)
+
+def is_plain_query(con, sql):
+    """Whether sql is exactly one query, so running it cannot change the database"""
+    try:
+        statements = con.extract_statements(sql)
+    except duckdb.Error:
+        return False
+    return len(statements) == 1 and is_query_statement(statements[0])
+
+def validate_sql(con, sql):
+    """Parse, bind and plan SQL against the loaded tables with EXPLAIN, without reading any rows.
+
+    Returns DuckDB's error message, or None if the SQL is valid. Only a single query is planned.
+    Scripts run on a private connection where each statement sees what the ones before it created,
+    so planning them here would reject valid scripts; only their syntax is checked, and the job
+    running them reports the rest.
+    """
+    with phase_timer('validate'):
+        try:
+            statements = con.extract_statements(sql)
+            if len(statements) == 1 and is_query_statement(statements[0]):
+                con.execute(f"EXPLAIN {statements[0].query}")
+        except duckdb.Error as e:
+            return str(e)
+    return None
+
+def generate_sql(con, prompt, schema_str, rule_text, max_fixes=0):
+    """Generate SQL for a rule, then up to max_fixes times send what fails validation back to be fixed.
+
+    Every model call is recorded in the prompt history. Returns (sql, validation error or None);
+    with max_fixes=0 the SQL is returned unvalidated.
+    """
+    sql_raw, tokens, cached = complete_sql(prompt, llm_cache_key('generate', schema_str, rule_text))
+    record_prompt({
+        'timestamp': datetime.now().isoformat(),
+        'type': 'SQL Generation',
+        'prompt': prompt,
+        'response': sql_raw,
+        'model': LLM_MODEL,
+        'tokens': tokens,
+        'cached': cached,
+        'rule_text': rule_text
+    })
+    # Remove markdown code block markers from LLM output
+    sql = re.sub(r'^```[a-zA-Z]*\s*', '', sql_raw)
+    sql = re.sub(r'```$', '', sql.strip())
+    if not max_fixes:
+        return sql, None
+    error = validate_sql(con, sql)
+    for attempt in range(1, max_fixes + 1):
+        if not error:
+            break
+        fix_prompt = sql_fix_prompt(prompt, sql, error)
+        sql_raw, tokens, cached = complete_sql(fix_prompt, llm_cache_key('fix', schema_str, rule_text, sql, error))
+        record_prompt({
+            'timestamp': datetime.now().isoformat(),
+            'type': f'SQL Fix (automatic, attempt {attempt})',
+            'prompt': fix_prompt,
+            'response': sql_raw,
+            'model': LLM_MODEL,
+            'tokens': tokens,
+            'cached': cached,
+            'rule_text': rule_text,
+            'error': error
+        })
+        fixed_sql = re.sub(r'^```[a-zA-Z]*\s*', '', sql_raw)
+        fixed_sql = re.sub(r'```$', '', fixed_sql.strip())
+        if fixed_sql == sql:
+            break  # the model returned the same SQL, so asking again would not help
+        sql = fixed_sql
+        error = validate_sql(con, sql)
+    return sql, error
+
+llm_cache_stats = {'hits': 0, 'misses': 0}
+_llm_cache_stats_lock = threading.Lock()
+
+def llm_cache_key(kind, schema_str, rule_text, *extra):
+    """Key a generate/fix request by model, temperature, schema hash and whitespace-normalized rule"""
+    payload = json.dumps([
+        LLM_MODEL,
+        LLM_TEMPERATURE,
+        kind,
+        hashlib.sha256(schema_str.encode('utf-8')).hexdigest(),
+        ' '.join(rule_text.split()),
+        [' '.join(str(value or '').split()) for value in extra],
+    ])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def llm_cache_db():
+    db = sqlite3.connect(LLM_CACHE_PATH, timeout=30)
+    db.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, response TEXT, tokens, last_used REAL)")
+    return db
+
+def count_llm_cache(stat):
+    with _llm_cache_stats_lock:
+        llm_cache_stats[stat] += 1
+    increment('queryx_llm_requests_total', result='hit' if stat == 'hits' else 'miss')
+
+def complete_sql(prompt, cache_key, rate_limiter=None):
+    """Ask the model for SQL, answering repeated requests from the LLM cache.
+
+    Cache hits skip rate_limiter; only actual API requests wait on it.
+    Returns (raw response text, total tokens, whether it came from the cache).
+    """
+    with closing(llm_cache_db()) as db, db:
+        row = db.execute("SELECT response, tokens FROM llm_cache WHERE key = ?", (cache_key,)).fetchone()
+        if row:
+            db.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (time.time(), cache_key))
+    if row:
+        count_llm_cache('hits')
+        return row[0], row[1], True
+    count_llm_cache('misses')
+    if rate_limiter:
+        rate_limiter.wait()
+    with phase_timer('llm'):
+        response = openai.chat.completions.create(
+            model=LLM_MODEL,
+            messages=[
+                {"role": "system", "content": "You are a helpful assistant that writes SQL queries for DuckDB."},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=512,
+            temperature=LLM_TEMPERATURE
+        )
+    sql_raw = response.choices[0].message.content.strip()
+    tokens = response.usage.total_tokens if getattr(response, 'usage', None) else 'N/A'
+    if isinstance(tokens, int):
+        increment('queryx_llm_tokens_total', tokens)
+    with closing(llm_cache_db()) as db, db:
+        db.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?)", (cache_key, sql_raw, tokens, time.time()))
+        # Evict the least recently used entries beyond the size limit
+        db.execute("DELETE FROM llm_cache WHERE key NOT IN (SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT ?)", (LLM_CACHE_MAX_ENTRIES,))
+    return sql_raw, tokens, False
+
+def clean_sql(sql):
+    """Strip code fences, surrounding whitespace and trailing semicolons; this is the SQL that runs"""
+    sql = re.sub(r'^```[a-zA-Z]*\s*', '', (sql or '').strip())
+    return re.sub(r'[\s;]+$', '', re.sub(r'```$', '', sql.strip()))
+
+def normalize_sql(sql):
+    """clean_sql() with comments dropped and whitespace outside string literals collapsed, for cache keys.
+
+    Comments go first: collapsing the newline that ends a -- comment would pull the next line into it.
+    """
+    sql = clean_sql(sql)
+    sql = re.sub(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")|(?:\s|--[^\n]*|/\*.*?\*/)+""", lambda m: m.group(1) or ' ', sql, flags=re.S)
+    return sql.strip()
+
+def result_cache_path(dataset, sql):
+    key = hashlib.sha256(f'{dataset}\n{normalize_sql(sql)}'.encode('utf-8')).hexdigest()
+    return os.path.join(RESULT_CACHE_FOLDER, f'{key}.parquet')
+
+def evict_result_cache(keep=None):
+    """Delete the least recently used cached results, except keep, until they fit in RESULT_CACHE_MAX_BYTES"""
+    entries = []
+    for entry in os.scandir(RESULT_CACHE_FOLDER):
+        if entry.name.endswith('.parquet'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= RESULT_CACHE_MAX_BYTES:
+            break
+        if path == keep:
+            continue
+        remove_file(path)
+        total -= size
+
+def write_state(path, state):
+    # Write next to the target and rename, so other workers never read a partial file
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'w') as fh:
+        json.dump(state, fh)
+    os.replace(temp_path, path)
+
+def read_state(path):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+# Started on first use rather than at import, since ingestion worker processes import this module too
+_watcher = None
+_watcher_lock = threading.Lock()
+
+def start_watcher():
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = threading.Thread(target=watch_background_work, daemon=True)
+            _watcher.start()
+
+def watch_background_work():
+    """Every JOB_POLL_SECONDS: close pooled connections idle past CONNECTION_IDLE_TIMEOUT, even when
+    no request comes to do it; cancel this process's jobs and batches when another worker process
+    was asked to cancel them; and touch the state files of its unfinished jobs so other workers
+    know it is still running them"""
+    while True:
+        time.sleep(JOB_POLL_SECONDS)
+        with _connections_lock:
+            evict_connections()
+        with _jobs_lock:
+            jobs = [job for job in _jobs.values() if not job.done.is_set()]
+        with _batches_lock:
+            batches = [batch for batch in _batches.values() if not batch.done.is_set()]
+        for job in jobs:
+            try:
+                os.utime(job.state_path)
+            except OSError:
+                pass
+        for run in jobs + batches:
+            if not run.cancel_requested and os.path.exists(run.cancel_path):
+                run.cancel()
+
+class QueryJobError(Exception):
+    """A background query failed, timed out or was cancelled"""
+
+class QueryJob:
+    """One SQL statement run in the background against a session's dataset"""
+
+    def __init__(self, job_id, sql, filepaths, mapping):
+        self.id = job_id
+        self.sql = clean_sql(sql)
+        self.filepaths = filepaths
+        self.mapping = mapping
+        self.dataset = dataset_key(filepaths, mapping)
+        self.status = 'queued'  # queued, running, done, failed, cancelled, timeout
+        self.error = None
+        self.result_path = None
+        self.total_rows = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.cursor = None
+        self.cancel_requested = False
+        self.timed_out = False
+        self.cached = False
+        self.done = threading.Event()
+        self.state_path = os.path.join(JOB_FOLDER, f'{job_id}.json')
+        self.cancel_path = os.path.join(JOB_FOLDER, f'{job_id}.cancel')
+        self.remote = False  # run by another worker process and followed through its state file
+
+    # Fields shared with other worker processes through the state file
+    STATE_FIELDS = ('sql', 'filepaths', 'mapping', 'status', 'error', 'result_path', 'total_rows',
+                    'submitted', 'started', 'finished', 'timed_out', 'cached')
+
+    def save(self):
+        write_state(self.state_path, {'job_id': self.id, **{field: getattr(self, field) for field in self.STATE_FIELDS}})
+
+    @classmethod
+    def from_state(cls, state):
+        job = cls(state['job_id'], state['sql'], state['filepaths'], state['mapping'])
+        job.remote = True
+        job.load_state(state)
+        return job
+
+    def load_state(self, state):
+        for field in self.STATE_FIELDS:
+            setattr(self, field, state[field])
+        if self.status in JOB_FINISHED_STATUSES:
+            self.done.set()
+
+    def wait(self):
+        """Block until the job has finished, here or in the worker process running it"""
+        while not self.done.wait(None if not self.remote else JOB_POLL_SECONDS):
+            state = read_state(self.state_path)
+            if state is None:
+                raise QueryJobError("Query job disappeared.")
+            self.load_state(state)
+            self.check_lost()
+
+    def check_lost(self):
+        """Fail a job run by another worker process that stopped before finishing it"""
+        if not self.remote or self.done.is_set():
+            return
+        now = time.time()
+        try:
+            heartbeat = os.path.getmtime(self.state_path)
+        except OSError:
+            heartbeat = 0
+        overdue = self.started is not None and now > self.started + QUERY_TIMEOUT + JOB_LOST_SECONDS
+        if overdue or now - heartbeat > JOB_LOST_SECONDS:
+            self.status = 'failed'
+            self.error = "The worker process running this query stopped before it finished."
+            self.finished = now
+            self.save()
+            self.done.set()
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def cancel(self, timed_out=False):
+        if self.remote:
+            # The worker running the job picks this up in watch_background_work()
+            open(self.cancel_path, 'a').close()
+            return
+        self.cancel_requested = True
+        self.timed_out = timed_out
+        cursor = self.cursor
+        if cursor is not None:
+            cursor.interrupt()
+
+    def message(self):
+        if self.status == 'timeout':
+            return f"Query stopped after exceeding the {QUERY_TIMEOUT:g} second time limit."
+        if self.status == 'cancelled':
+            return "Query was cancelled."
+        return self.error or ''
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'elapsed': round(self.elapsed(), 3),
+            'total_rows': self.total_rows,
+            'cached': self.cached,
+            'error': self.message() or None,
+        }
+
+# job id -> QueryJob
+_jobs = {}
+_jobs_lock = threading.Lock()
+_job_executor = ThreadPoolExecutor(max_workers=QUERY_JOB_WORKERS)
+
+def get_job(job_id):
+    """The job with this id, whichever worker process it was submitted to, or None"""
+    with _jobs_lock:
+        job = _jobs.get(job_id or '')
+    if job is None and re.fullmatch(r'[0-9a-f]{32}', job_id or ''):
+        state = read_state(os.path.join(JOB_FOLDER, f'{job_id}.json'))
+        if state:
+            job = QueryJob.from_state(state)
+            job.check_lost()
+    return job
+
+def prune_jobs():
+    """Forget finished jobs and their stored results after JOB_RETENTION seconds"""
+    cutoff = time.time() - JOB_RETENTION
+    with _jobs_lock:
+        expired = [job for job in _jobs.values() if job.finished and job.finished < cutoff]
+        for job in expired:
+            del _jobs[job.id]
+    # State files of every worker's jobs; results in the result cache outlive the job,
+    # so only uncacheable ones are removed
+    for entry in os.scandir(JOB_FOLDER):
+        if entry.name.endswith('.json') and entry.stat().st_mtime < cutoff:
+            job_id = entry.name[:-len('.json')]
+            for path in (entry.path, os.path.join(JOB_FOLDER, f'{job_id}.parquet'), os.path.join(JOB_FOLDER, f'{job_id}.cancel')):
+                remove_file(path)
+
+def submit_query_job(sql, filepaths, mapping, job_id=None):
+    prune_jobs()
+    # Browsers may pick the id themselves so they can poll and cancel while the form posts
+    if not job_id or not re.fullmatch(r'[0-9a-f]{32}', job_id) or get_job(job_id):
+        job_id = uuid.uuid4().hex
+    job = QueryJob(job_id, sql, filepaths, mapping)
+    job.save()
+    with _jobs_lock:
+        _jobs[job.id] = job
+    start_watcher()
+    _job_executor.submit(run_query_job, job)
+    return job
+
+def query_job_for(job_id, sql, filepaths, mapping):
+    """Reuse the job that already ran this SQL on this dataset, or submit a new one"""
+    job = get_job(job_id)
+    if job and job.sql == clean_sql(sql) and job.dataset == dataset_key(filepaths, mapping) and job.status in ('queued', 'running', 'done'):
+        if job.status != 'done' or os.path.exists(job.result_path):
+            return job
+    return submit_query_job(sql, filepaths, mapping, job_id)
+
+def run_query_job(job):
+    if job.cancel_requested:
+        job.status = 'cancelled'
+        job.finished = time.time()
+        job.save()
+        job.done.set()
+        return
+    job.status = 'running'
+    job.started = time.time()
+    job.save()
+    timer = threading.Timer(QUERY_TIMEOUT, job.cancel, kwargs={'timed_out': True})
+    try:
+        cached_path = result_cache_path(job.dataset, job.sql)
+        if os.path.exists(cached_path):
+            # Same SQL on the same data ran before, so skip loading the dataset entirely
+            os.utime(cached_path)
+            job.cached = True
+            target = cached_path
+            with closing(duckdb.connect()) as con:
+                job.total_rows = con.execute(f"SELECT count(*) FROM read_parquet({quote_literal(target)})").fetchone()[0]
+        else:
+            target = None
+            with dataset_cursor(job.filepaths, job.mapping) as (con, duckdb_columns):
+                # Only a single plain query may run on the pooled database other sessions share
+                if is_plain_query(con, job.sql):
+                    job.cursor = con
+                    timer.start()
+                    if job.cancel_requested:
+                        raise duckdb.InterruptException("Interrupted before start")
+                    try:
+                        write_atomic_parquet(con, job.sql, cached_path)
+                        target = cached_path
+                    except duckdb.ParserException:
+                        pass  # cannot be wrapped in COPY (SHOW, PRAGMA...), so it runs as it is below
+                    job.cursor = None
+            if target is None:
+                # Other statements (DDL, SET, several statements...) run as they are on a private
+                # connection that is thrown away afterwards, and are not cached since they may have side effects
+                target = os.path.join(JOB_FOLDER, f'{job.id}.parquet')
+                with scratch_dataset(job.filepaths, job.mapping) as (con, duckdb_columns):
+                    job.cursor = con
+                    if timer.ident is None:
+                        timer.start()
+                    if job.cancel_requested:
+                        raise duckdb.InterruptException("Interrupted before start")
+                    cursor = con.execute(job.sql)
+                    result_df = cursor.fetchdf() if cursor.description else pd.DataFrame({'status': ['Statement executed']})
+                    job.cursor = None
+                    con.register('result_df', result_df)
+                    write_atomic_parquet(con, "SELECT * FROM result_df", target)
+            with closing(duckdb.connect()) as con:
+                job.total_rows = con.execute(f"SELECT count(*) FROM read_parquet({quote_literal(target)})").fetchone()[0]
+            if target == cached_path:
+                evict_result_cache(keep=target)
+        job.result_path = target
+        job.status = 'done'
+    except duckdb.InterruptException:
+        job.status = 'timeout' if job.timed_out else 'cancelled'
+    except Exception as e:
+        job.status = 'failed'
+        job.error = str(e)
+    finally:
+        timer.cancel()
+        job.cursor = None
+        job.finished = time.time()
+        observe('queryx_query_seconds', job.elapsed(), status=job.status)
+        if job.status == 'done':
+            increment('queryx_query_rows_total', job.total_rows or 0)
+        job.save()
+        job.done.set()
+
+def job_result_sql(job):
+    """Wait for a job and return SQL that reads its stored result"""
+    with phase_timer('query'):
+        job.wait()
+    if job.status != 'done':
+        raise QueryJobError(job.message())
+    return f"SELECT * FROM read_parquet({quote_literal(job.result_path)})"
+
+def job_preview(job, page):
+    result_sql = job_result_sql(job)
+    with phase_timer('preview'), closing(duckdb.connect()) as con:
+        return preview_query(con, result_sql, page)
+
+def api_filepaths(data):
+    """Workbooks an API request names in 'datasets' (a list or comma-separated ids), else the session's upload set"""
+    dataset_ids = data.get('datasets') or []
+    if isinstance(dataset_ids, str):
+        dataset_ids = [dataset_id for dataset_id in dataset_ids.split(',') if dataset_id]
+    filepaths = dataset_paths(dataset_ids) if dataset_ids else session.get('filepaths', [])
+    if not filepaths:
+        raise LookupError('No datasets given')
+    return filepaths
+
+def json_value(value):
+    """Coerce a DuckDB value to something JSON can carry; dates and times become ISO 8601 strings"""
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date, dt_time)):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)):
+        return [json_value(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): json_value(item) for key, item in value.items()}
+    return str(value)
+
+def arrow_stream(result_sql):
+    """Yield a stored result as an Arrow IPC stream, one record batch of EXPORT_BATCH_ROWS at a time"""
+    import pyarrow as pa
+    sink = BytesIO()
+    sent = 0
+    with closing(duckdb.connect()) as con:
+        reader = con.execute(result_sql).fetch_record_batch(EXPORT_BATCH_ROWS)
+        with pa.ipc.new_stream(sink, reader.schema) as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+                chunk = sink.getvalue()
+                sink.seek(0)
+                sink.truncate()
+                sent += len(chunk)
+                yield chunk
+    chunk = sink.getvalue()
+    increment('queryx_export_bytes_total', sent + len(chunk), format='arrow')
+    yield chunk
+
+class RateLimiter:
+    """Spaces calls evenly so that at most per_minute of them start each minute, across threads"""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self.next_call = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+_batch_llm_limiter = RateLimiter(BATCH_LLM_RPM)
+
+def parse_rule_list(text, upload=None):
+    """Rules from pasted text and an optional .txt or .csv upload, one per line (first CSV column).
+
+    Blank lines and lines starting with # are skipped, as is a CSV header named "rule".
+    """
+    lines = text.splitlines()
+    if upload and upload.filename:
+        content = upload.read().decode('utf-8-sig', errors='replace')
+        if upload.filename.lower().endswith('.csv'):
+            rows = [row[0] for row in csv.reader(io.StringIO(content)) if row]
+            if rows and rows[0].strip().lower() in ('rule', 'rules', 'rule_text'):
+                rows = rows[1:]
+            lines += rows
+        else:
+            lines += content.splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith('#')]
+
+class BatchRun:
+    """A list of rules whose SQL is generated and run in the background against one dataset"""
+
+    def __init__(self, batch_id, rule_list, filepaths, mapping):
+        self.id = batch_id
+        self.filepaths = filepaths
+        self.mapping = mapping
+        self.rules = [{
+            'index': index,
+            'rule': rule_text,
+            'status': 'queued',  # queued, generating, generated, running, done, failed, timeout, cancelled
+            'sql': None,
+            'rows': None,
+            'generate_seconds': None,
+            'query_seconds': None,
+            'tokens': None,
+            'cached': False,
+            'error': None,
+            'result_path': None,
+        } for index, rule_text in enumerate(rule_list, 1)]
+        self.folder = os.path.join(BATCH_FOLDER, batch_id)
+        self.status = 'queued'  # queued, running, done, failed, cancelled
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.cursor = None
+        self.cancel_requested = False
+        self.done = threading.Event()
+        self.state_path = os.path.join(self.folder, 'batch.json')
+        self.cancel_path = os.path.join(self.folder, 'cancel')
+        self.remote = False  # run by another worker process and read from its state file
+        self.save_lock = threading.Lock()
+
+    # Fields shared with other worker processes through the state file
+    STATE_FIELDS = ('filepaths', 'mapping', 'rules', 'status', 'error', 'submitted', 'started', 'finished')
+
+    def save(self):
+        # Rules finish on several threads at once
+        with self.save_lock:
+            write_state(self.state_path, {'batch_id': self.id, **{field: getattr(self, field) for field in self.STATE_FIELDS}})
+
+    @classmethod
+    def from_state(cls, state):
+        batch = cls(state['batch_id'], [], state['filepaths'], state['mapping'])
+        batch.remote = True
+        for field in cls.STATE_FIELDS:
+            setattr(batch, field, state[field])
+        if batch.status in JOB_FINISHED_STATUSES:
+            batch.done.set()
+        return batch
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def cancel(self):
+        if self.remote:
+            # The worker running the batch picks this up in watch_background_work()
+            open(self.cancel_path, 'a').close()
+            return
+        self.cancel_requested = True
+        cursor = self.cursor
+        if cursor is not None:
+            cursor.interrupt()
+
+    def to_dict(self):
+        finished = [rule for rule in self.rules if rule['status'] in ('done', 'failed', 'timeout', 'cancelled')]
+        return {
+            'batch_id': self.id,
+            'status': self.status,
+            'elapsed': round(self.elapsed(), 3),
+            'total': len(self.rules),
+            'finished': len(finished),
+            'succeeded': sum(1 for rule in finished if rule['status'] == 'done'),
+            'tokens': sum(rule['tokens'] for rule in self.rules if isinstance(rule['tokens'], int) and not rule['cached']),
+            'error': self.error,
+            'rules': [{key: value for key, value in rule.items() if key != 'result_path'} for rule in self.rules],
+        }
+
+# batch id -> BatchRun
+_batches = {}
+_batches_lock = threading.Lock()
+# Each batch is driven by one thread; generation for all batches shares the LLM pool
+_batch_executor = ThreadPoolExecutor(max_workers=2)
+_batch_llm_executor = ThreadPoolExecutor(max_workers=BATCH_LLM_WORKERS)
+
+def get_batch(batch_id):
+    """The batch with this id, whichever worker process it was submitted to, or None"""
+    with _batches_lock:
+        batch = _batches.get(batch_id or '')
+    if batch is None and re.fullmatch(r'[0-9a-f]{32}', batch_id or ''):
+        state = read_state(os.path.join(BATCH_FOLDER, batch_id, 'batch.json'))
+        if state:
+            batch = BatchRun.from_state(state)
+    return batch
+
+def prune_batches():
+    """Forget finished batches and their stored results after JOB_RETENTION seconds"""
+    cutoff = time.time() - JOB_RETENTION
+    with _batches_lock:
+        expired = [batch for batch in _batches.values() if batch.finished and batch.finished < cutoff]
+        for batch in expired:
+            del _batches[batch.id]
+    # Folders of every worker's batches
+    for entry in os.scandir(BATCH_FOLDER):
+        state = read_state(os.path.join(entry.path, 'batch.json')) if entry.is_dir() else None
+        if state and state['finished'] and state['finished'] < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+def submit_batch_run(rule_list, filepaths, mapping):
+    prune_batches()
+    batch = BatchRun(uuid.uuid4().hex, rule_list, filepaths, mapping)
+    os.makedirs(batch.folder, exist_ok=True)
+    batch.save()
+    with _batches_lock:
+        _batches[batch.id] = batch
+    start_watcher()
+    _batch_executor.submit(run_batch, batch)
+    return batch
+
+def run_batch(batch):
+    """Generate SQL for every rule concurrently and run each query as soon as its SQL arrives"""
+    batch.status = 'running'
+    batch.started = time.time()
+    batch.save()
+    try:
+        with dataset_cursor(batch.filepaths, batch.mapping) as (con, duckdb_columns):
+            schema_str = schema_description(duckdb_columns)
+            futures = {_batch_llm_executor.submit(generate_batch_sql, batch, rule, schema_str): rule for rule in batch.rules}
+            for future in as_completed(futures):
+                rule = futures[future]
+                if rule['status'] == 'generated':
+                    run_batch_query(batch, con, rule)
+        batch.status = 'cancelled' if batch.cancel_requested else 'done'
+    except Exception as e:
+        batch.status = 'failed'
+        batch.error = str(e)
+    finally:
+        batch.cursor = None
+        batch.finished = time.time()
+        batch.save()
+        batch.done.set()
+
+def generate_batch_sql(batch, rule, schema_str):
+    if batch.cancel_requested:
+        rule['status'] = 'cancelled'
+        return
+    rule['status'] = 'generating'
+    started = time.time()
+    try:
+        for attempt in range(BATCH_LLM_RETRIES):
+            try:
+                sql_raw, tokens, cached = complete_sql(rule_prompt(schema_str, rule['rule']), llm_cache_key('generate', schema_str, rule['rule']), _batch_llm_limiter)
+                break
+            except openai.RateLimitError:
+                # Back off and retry when OpenAI rejects a request for exceeding the account's rate limit
+                if attempt == BATCH_LLM_RETRIES - 1 or batch.cancel_requested:
+                    raise
+                time.sleep(5 * 2 ** attempt)
+        # Remove markdown code block markers from LLM output
+        sql = clean_sql(sql_raw)
+        rule.update(sql=sql, tokens=tokens, cached=cached, status='generated')
+    except Exception as e:
+        rule.update(status='failed', error=f"OpenAI API error: {e}")
+    finally:
+        rule['generate_seconds'] = round(time.time() - started, 3)
+        batch.save()
+
+def run_batch_query(batch, con, rule):
+    """Run one rule's SQL under the query time limit and store its result as Parquet"""
+    if batch.cancel_requested:
+        rule['status'] = 'cancelled'
+        return
+    rule['status'] = 'running'
+    started = time.time()
+    timed_out = threading.Event()
+
+    def stop():
+        timed_out.set()
+        con.interrupt()
+
+    timer = threading.Timer(QUERY_TIMEOUT, stop)
+    batch.cursor = con
+    timer.start()
+    try:
+        statements = con.extract_statements(rule['sql'])  # syntax errors are reported as they are
+        if len(statements) != 1 or not is_query_statement(statements[0]):
+            raise ValueError("Only a single SELECT query can run in a batch")
+        target = os.path.join(batch.folder, f"rule_{rule['index']:03d}.parquet")
+        write_atomic_parquet(con, rule['sql'], target)
+        rule['rows'] = con.execute(f"SELECT count(*) FROM read_parquet({quote_literal(target)})").fetchone()[0]
+        rule['result_path'] = target
+        rule['status'] = 'done'
+    except duckdb.InterruptException:
+        if timed_out.is_set():
+            rule.update(status='timeout', error=f"Query stopped after exceeding the {QUERY_TIMEOUT:g} second time limit.")
+        else:
+            rule.update(status='cancelled', error="Query was cancelled.")
+    except Exception as e:
+        rule.update(status='failed', error=str(e))
+    finally:
+        timer.cancel()
+        batch.cursor = None
+        rule['query_seconds'] = round(time.time() - started, 3)
+        batch.save()
+
+BATCH_SUMMARY_COLUMNS = ['index', 'rule', 'status', 'rows', 'generate_seconds', 'query_seconds', 'tokens', 'cached', 'error', 'sql']
+
+def export_batch(batch, download_format, path):
+    """Write a finished batch as one workbook or a zip of Parquet files, each with a summary first"""
+    summary = pd.DataFrame([[rule[col] for col in BATCH_SUMMARY_COLUMNS] for rule in batch.rules], columns=BATCH_SUMMARY_COLUMNS)
+    summary['tokens'] = pd.to_numeric(summary['tokens'], errors='coerce').astype('Int64')
+    done = [rule for rule in batch.rules if rule['status'] == 'done']
+    with closing(duckdb.connect()) as con:
+        con.register('summary', summary)
+        if download_format == 'excel':
+            import openpyxl
+            wb = openpyxl.Workbook(write_only=True)
+            write_excel_sheet(wb, 'Summary', con.execute("SELECT * FROM summary"))
+            for rule in done:
+                write_excel_sheet(wb, f"Rule {rule['index']}", con.execute(f"SELECT * FROM read_parquet({quote_literal(rule['result_path'])})"))
+            wb.save(path)
+        else:
+            summary_path = os.path.join(batch.folder, 'summary.parquet')
+            con.execute(f"COPY summary TO {quote_literal(summary_path)} (FORMAT PARQUET)")
+            # Parquet is already compressed, so the files are stored as they are
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as bundle:
+                bundle.write(summary_path, 'summary.parquet')
+                for rule in done:
+                    bundle.write(rule['result_path'], os.path.basename(rule['result_path']))
+            remove_file(summary_path)
+
+def history_db():
+    db = sqlite3.connect(HISTORY_PATH, timeout=30)
+    db.row_factory = sqlite3.Row
+    db.execute("""CREATE TABLE IF NOT EXISTS prompt_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        timestamp TEXT,
+        type TEXT,
+        prompt TEXT,
+        response TEXT,
+        model TEXT,
+        tokens,
+        cached INTEGER DEFAULT 0,
+        rule_text TEXT,
+        error TEXT
+    )""")
+    db.execute("CREATE INDEX IF NOT EXISTS prompt_history_session ON prompt_history (session_id, id)")
+    return db
+
+def history_session_id():
+    if 'history_id' not in session:
+        session['history_id'] = uuid.uuid4().hex
+    return session['history_id']
+
+def record_prompt(prompt_data):
+    with closing(history_db()) as db, db:
+        db.execute(
+            "INSERT INTO prompt_history (session_id, timestamp, type, prompt, response, model, tokens, cached, rule_text, error) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (history_session_id(), prompt_data['timestamp'], prompt_data['type'], prompt_data['prompt'],
+             prompt_data['response'], prompt_data['model'], prompt_data['tokens'], int(prompt_data.get('cached', False)),
+             prompt_data.get('rule_text'), prompt_data.get('error')))
+
+def prompt_history(page=0):
+    """One page of this session's prompts, newest first, plus paging info and token usage"""
+    page = max(page, 0)
+    session_id = history_session_id()
+    with closing(history_db()) as db:
+        rows = db.execute(
+            "SELECT * FROM prompt_history WHERE session_id = ? ORDER BY id DESC LIMIT ? OFFSET ?",
+            (session_id, HISTORY_PAGE_SIZE + 1, page * HISTORY_PAGE_SIZE)).fetchall()
+        # Cache hits cost no tokens, so they are left out of the usage total
+        total, tokens, cached = db.execute(
+            "SELECT count(*), coalesce(sum(CASE WHEN typeof(tokens) = 'integer' AND NOT cached THEN tokens END), 0), "
+            "coalesce(sum(cached), 0) FROM prompt_history WHERE session_id = ?", (session_id,)).fetchone()
+    history = {
+        'page': page,
+        'has_next': len(rows) > HISTORY_PAGE_SIZE,
+        'total': total,
+        'tokens': tokens,
+        'cached': cached,
+    }
+    return [dict(row) for row in rows[:HISTORY_PAGE_SIZE]], history
+
+# sha256 -> sheet metadata, mirrored to metadata.json in the workbook's cache directory
+_sheet_metadata = {}
+
+def header_names(values):
+    """Name header cells the way pandas does: blanks become 'Unnamed: N', repeats get '.1', '.2'..."""
+    values = list(values)
+    while values and values[-1] is None:
+        values.pop()
+    names = []
+    seen = {}
+    for idx, value in enumerate(values):
+        name = f'Unnamed: {idx}' if value is None or str(value).strip() == '' else str(value)
+        base = name
+        while name in seen:
+            seen[base] += 1
+            name = f'{base}.{seen[base]}'
+        seen.setdefault(name, 0)
+        names.append(name)
+    return names
+
+def scan_workbook(path, meta_path):
+    """Read the header row and row count of every sheet and store them in meta_path"""
+    import openpyxl
+    sheets = []
+    # read_only streams the worksheet XML instead of building every cell
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        for sheet in wb.sheetnames:
+            ws = wb[sheet]
+            if not hasattr(ws, 'iter_rows'):
+                continue  # chartsheets have no cells
+            header = next(ws.iter_rows(min_row=1, max_row=1, values_only=True), ())
+            max_row = ws.max_row
+            if max_row is None:
+                # No <dimension> element in the sheet XML, count the rows instead
+                max_row = sum(1 for _ in ws.iter_rows(values_only=True))
+            sheets.append({'sheet': sheet, 'columns': header_names(header), 'row_count': max(max_row - 1, 0)})
+    finally:
+        wb.close()
+    os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+    # Background ingestion and a request can scan the same workbook at once, so the name is per thread too
+    temp_path = f'{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'w') as fh:
+        json.dump(sheets, fh)
+    os.replace(temp_path, meta_path)
+    return sheets
+
+def metadata_path(path):
+    return os.path.join(CACHE_FOLDER, file_digest(path), 'metadata.json')
+
+def sheet_metadata(path):
+    """Header names and row count of every sheet, cached per upload.
+
+    Returns a list of {'sheet': ..., 'columns': [...], 'row_count': ...} in workbook order.
+    """
+    digest = file_digest(path)
+    if digest in _sheet_metadata:
+        return _sheet_metadata[digest]
+    meta_path = metadata_path(path)
+    if os.path.exists(meta_path):
+        with open(meta_path) as fh:
+            sheets = json.load(fh)
+    else:
+        sheets = scan_workbook(path, meta_path)
+    _sheet_metadata[digest] = sheets
+    return sheets
+
+def scan_workbooks(filepaths):
+    # Scan workbooks without cached metadata in parallel
+    run_ingest_tasks(scan_workbook, [(path, metadata_path(path)) for path in filepaths if not os.path.exists(metadata_path(path))])
+
 def get_excel_data(filepaths):
     data = {}
     sheet_name_counter = {}  # Track sheet names across all files
     
+    wait_for_pending_scans(filepaths)
+    scan_workbooks(filepaths)
+    
     for path in filepaths:
-        xls = pd.ExcelFile(path)
         data[os.path.basename(path)] = {}
-        for sheet in xls.sheet_names:
-            df = xls.parse(sheet)
+        for meta in sheet_metadata(path):
+            sheet = meta['sheet']
             columns = []
-            for col in df.columns:
-                safe_col = re.sub(r'[^a-zA-Z0-9_]', '', col.replace(' ', '_').replace('-', '_')).lower()
-                columns.append({'original': col, 'safe': safe_col})
+            for col in meta['columns']:
+                columns.append({'original': col, 'safe': safe_name(col)})
             
             # Generate safe table name from sheet name
-            base_safe_sheet = re.sub(r'[^a-zA-Z0-9_]', '', sheet.replace(' ', '_').replace('-', '_')).lower()
+            base_safe_sheet = safe_name(sheet)
             
             # Handle duplicate sheet names by adding numbers
             if base_safe_sheet in sheet_name_counter:
@@ -531,7 +2746,7 @@ def get_excel_data(filepaths):
             data[os.path.basename(path)][sheet] = {
                 'columns': columns, 
                 'safe_sheet': safe_sheet,
-                'row_count': len(df)  # Add row count for display
+                'row_count': meta['row_count']  # Add row count for display
             }
     return data
 
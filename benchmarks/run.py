@@ -0,0 +1,240 @@
+"""Benchmark the queryX routes end to end on synthetic workbooks.
+
+Each scenario runs in a fresh process and working directory, so caches start cold and peak
+RSS is per scenario. OpenAI is stubbed; everything else (upload, mapping, ingestion, DuckDB,
+jobs, exports) is the real code driven through Flask's test client.
+
+    python benchmarks/run.py                          # default scenarios
+    python benchmarks/run.py small wide --save main   # store results as baselines/main.json
+    python benchmarks/run.py --compare main           # compare with a stored baseline
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+WORKBOOK_FOLDER = os.path.join(BENCH_DIR, '.workbooks')
+BASELINE_FOLDER = os.path.join(BENCH_DIR, 'baselines')
+sys.path.insert(0, BENCH_DIR)
+
+from workbooks import generate_dataset
+
+# Workbook shape and number of repetitions of each timed request
+SCENARIOS = {
+    'small': {'files': 1, 'sheets': 2, 'rows': 1000, 'columns': 12, 'iterations': 20},
+    'medium': {'files': 1, 'sheets': 3, 'rows': 50000, 'columns': 12, 'iterations': 10},
+    'wide': {'files': 1, 'sheets': 1, 'rows': 10000, 'columns': 120, 'iterations': 5},
+    'many_files': {'files': 5, 'sheets': 2, 'rows': 5000, 'columns': 12, 'iterations': 10},
+    # More rows than QUERYX_STREAMING_ROW_THRESHOLD, so the sheet is streamed
+    'streaming': {'files': 1, 'sheets': 1, 'rows': 250000, 'columns': 12, 'iterations': 5},
+}
+DEFAULT_SCENARIOS = ['small', 'medium', 'wide', 'many_files']
+# p50/p90 growth over the baseline, in percent, that is reported as a regression; latencies must
+# also grow by REGRESSION_MIN_MS, so noise on millisecond-scale steps is not flagged
+REGRESSION_THRESHOLD = 25.0
+REGRESSION_MIN_MS = 5.0
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+def percentile(values, p):
+    """Linearly interpolated percentile of values, p in 0..100"""
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return ordered[0]
+    rank = (len(ordered) - 1) * p / 100.0
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(who).ru_maxrss * scale / (1024 * 1024)
+
+def stub_openai(queryx, table):
+    """Answer every completion with a valid query on table, as a real model would on a good day"""
+    def create(**kwargs):
+        content = f"```sql\nSELECT status, count(*) AS n FROM {table} GROUP BY 1 ORDER BY 2 DESC\n```"
+        return types.SimpleNamespace(
+            choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=content))],
+            usage=types.SimpleNamespace(total_tokens=0),
+        )
+    queryx.openai.chat.completions.create = create
+
+def run_scenario(name, spec):
+    """Drive the routes for one scenario in this process and return its measurements"""
+    paths = generate_dataset(WORKBOOK_FOLDER, spec['files'], spec['sheets'], spec['rows'], spec['columns'])
+    os.chdir(tempfile.mkdtemp(prefix=f'queryx-bench-{name}-'))
+    sys.path.insert(0, REPO_ROOT)
+    import app as queryx
+
+    client = queryx.app.test_client()
+    timings = {}
+
+    def timed(step, method, url, **kwargs):
+        started = time.perf_counter()
+        response = getattr(client, method)(url, **kwargs)
+        timings.setdefault(step, []).append(time.perf_counter() - started)
+        body = response.get_data(as_text=True) if response.mimetype == 'text/html' else ''
+        if response.status_code >= 400 or 'Database Error' in body or 'class="error-msg"' in body:
+            raise RuntimeError(f'{step} failed with status {response.status_code}')
+        return response
+
+    uploads = [(open(path, 'rb'), os.path.basename(path)) for path in paths]
+    try:
+        timed('upload', 'post', '/', data={'files': uploads}, content_type='multipart/form-data')
+    finally:
+        for fh, _ in uploads:
+            fh.close()
+    timed('mapping_cold', 'get', '/mapping')
+    timed('mapping', 'get', '/mapping')
+
+    # Keep the suggested names, as a user clicking Save Mapping would
+    with client.session_transaction() as sess:
+        filepaths = sess['filepaths']
+    form = {}
+    for file_path, sheets in queryx.get_excel_data(filepaths).items():
+        for sheet, sheetdata in sheets.items():
+            form[f'table_{file_path}_{sheet}'] = sheetdata['safe_sheet']
+            for idx, col in enumerate(sheetdata['columns']):
+                form[f'col_{file_path}_{sheet}_{idx}'] = col['safe']
+    timed('mapping_save', 'post', '/mapping', data=form)
+    table = queryx.safe_name(next(value for key, value in form.items() if key.startswith('table_')))
+    stub_openai(queryx, table)
+
+    # The first load parses and profiles every sheet; later requests use the pooled connection
+    timed('rules_cold', 'get', '/rules')
+    timed('rules', 'get', '/rules')
+
+    cached_sql = f"SELECT department_id, count(*) AS n, avg(salary) AS avg_salary FROM {table} GROUP BY 1 ORDER BY 1"
+    for i in range(spec['iterations']):
+        # A different filter each time, so every query really runs
+        sql = f"SELECT department_id, count(*) AS n, avg(salary) AS avg_salary FROM {table} WHERE id > {i} GROUP BY 1 ORDER BY 1"
+        timed('write', 'post', '/rules', data={'action': 'write', 'sql': sql, 'tab_source': 'write'})
+        timed('write_cached', 'post', '/rules', data={'action': 'write', 'sql': cached_sql, 'tab_source': 'write'})
+        timed('test', 'post', '/rules', data={'action': 'test', 'sql': sql, 'api_key': 'bench', 'tab_source': 'generate'})
+        timed('generate', 'post', '/rules', data={'action': 'generate', 'api_key': 'bench', 'rule_text': f'Employees per status {i}', 'auto_fix': 'on'})
+        export_sql = f"SELECT * FROM {table} WHERE id > {i}"
+        for download_format in ('csv', 'parquet', 'excel'):
+            timed(f'download_{download_format}', 'post', '/download', data={'sql': export_sql, 'format': download_format})
+
+    if queryx._ingest_pool is not None:
+        queryx._ingest_pool.shutdown()
+    total_rows = spec['files'] * spec['sheets'] * spec['rows']
+    return {
+        'scenario': name,
+        'spec': spec,
+        'steps': {
+            step: {
+                'n': len(values),
+                'p50_ms': percentile(values, 50) * 1000,
+                'p90_ms': percentile(values, 90) * 1000,
+                'p99_ms': percentile(values, 99) * 1000,
+                'max_ms': max(values) * 1000,
+                'throughput_rps': len(values) / sum(values),
+            }
+            for step, values in timings.items()
+        },
+        'ingest_rows_per_second': total_rows / timings['rules_cold'][0],
+        'peak_rss_mb': peak_rss_mb(resource.RUSAGE_SELF),
+        'children_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+def run_in_subprocess(name, env_overrides):
+    env = dict(os.environ, **env_overrides)
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', name],
+                          env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    for line in proc.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError(f'Scenario {name} failed:\n{proc.stderr[-4000:]}')
+
+def print_result(result):
+    spec = result['spec']
+    print(f"\n== {result['scenario']}: {spec['files']} file(s) x {spec['sheets']} sheet(s) x {spec['rows']} rows x {spec['columns']} columns")
+    print(f"{'step':<18}{'n':>4}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'req/s':>9}")
+    for step, stats in result['steps'].items():
+        print(f"{step:<18}{stats['n']:>4}{stats['p50_ms']:>10.1f}{stats['p90_ms']:>10.1f}{stats['p99_ms']:>10.1f}"
+              f"{stats['max_ms']:>10.1f}{stats['throughput_rps']:>9.1f}")
+    print(f"ingest {result['ingest_rows_per_second']:,.0f} rows/s, peak RSS {result['peak_rss_mb']:.0f} MB "
+          f"(ingest workers {result['children_peak_rss_mb']:.0f} MB)")
+
+def compare(results, baseline, threshold):
+    """Print the change against the baseline and return the number of regressions"""
+    regressions = 0
+    print(f"\nCompared with baseline from {baseline['created']} ({baseline['machine']}):")
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        if base is None:
+            print(f"  {name}: not in baseline")
+            continue
+        if base['spec'] != result['spec']:
+            print(f"  {name}: scenario changed since the baseline, skipped")
+            continue
+        rows = [(f'{step} {metric}', base['steps'][step][metric], stats[metric])
+                for step, stats in result['steps'].items() if step in base['steps']
+                for metric in ('p50_ms', 'p90_ms')]
+        rows.append(('peak_rss_mb', base['peak_rss_mb'], result['peak_rss_mb']))
+        for label, before, after in rows:
+            change = (after - before) / before * 100 if before else 0.0
+            flag = ''
+            if change > threshold and (label == 'peak_rss_mb' or after - before > REGRESSION_MIN_MS):
+                flag = '  REGRESSION'
+                regressions += 1
+            print(f"  {name:<12}{label:<24}{before:>10.1f} -> {after:>10.1f}  {change:+6.1f}%{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('scenarios', nargs='*', help=f"scenarios to run (default: {' '.join(DEFAULT_SCENARIOS)}; all: {' '.join(SCENARIOS)})")
+    parser.add_argument('--save', metavar='NAME', help='store the results as baselines/NAME.json')
+    parser.add_argument('--compare', metavar='NAME', help='compare with baselines/NAME.json')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD, help='percent slowdown reported as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with status 1 if any regression is found')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help='environment for the app, e.g. QUERYX_EXCEL_READER=openpyxl')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        result = run_scenario(args.worker, SCENARIOS[args.worker])
+        print(RESULT_PREFIX + json.dumps(result))
+        return 0
+
+    names = args.scenarios or DEFAULT_SCENARIOS
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+    env_overrides = dict(item.split('=', 1) for item in args.env)
+    results = {}
+    for name in names:
+        results[name] = run_in_subprocess(name, env_overrides)
+        print_result(results[name])
+
+    regressions = 0
+    if args.compare:
+        with open(os.path.join(BASELINE_FOLDER, f'{args.compare}.json')) as fh:
+            regressions = compare(results, json.load(fh), args.threshold)
+    if args.save:
+        os.makedirs(BASELINE_FOLDER, exist_ok=True)
+        path = os.path.join(BASELINE_FOLDER, f'{args.save}.json')
+        baseline = {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'machine': f'{platform.node()} {platform.machine()} {platform.python_version()}',
+            'env': env_overrides,
+            'results': results,
+        }
+        with open(path, 'w') as fh:
+            json.dump(baseline, fh, indent=2)
+        print(f"\nSaved baseline {path}")
+    return 1 if regressions and args.fail_on_regression else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
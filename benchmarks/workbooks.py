@@ -0,0 +1,83 @@
+"""Generate synthetic Excel workbooks shaped like the sample data in test/.
+
+    python benchmarks/workbooks.py out_dir --files 2 --sheets 3 --rows 50000 --columns 12
+"""
+import argparse
+import os
+import random
+from datetime import date, timedelta
+
+import openpyxl
+
+FIRST_NAMES = ['James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael', 'Linda', 'David', 'Susan']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Nguyen', 'King']
+STATUSES = ['Active', 'Inactive', 'On Leave', 'Completed', 'In Progress']
+COURSES = ['Leadership', 'Python Basics', 'Data Privacy', 'Negotiation', 'Cloud Fundamentals']
+SHEET_NAMES = ['employees', 'departments', 'projects', 'performance_reviews', 'training_records']
+
+# (column name, value generator) cycled to the requested width; later cycles get a numeric suffix.
+# The mix mirrors the sample workbooks: ids, names, emails, foreign keys, money, dates,
+# categories, scores with gaps, zero-padded codes that must stay text, flags and free text.
+COLUMNS = [
+    ('id', lambda rng, i: i + 1),
+    ('name', lambda rng, i: f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'),
+    ('email', lambda rng, i: f'employee{i + 1}@company.com'),
+    ('department_id', lambda rng, i: rng.randint(1, 12)),
+    ('salary', lambda rng, i: round(rng.uniform(30000, 150000), 2)),
+    ('hire_date', lambda rng, i: date(2015, 1, 1) + timedelta(days=rng.randint(0, 3650))),
+    ('status', lambda rng, i: rng.choice(STATUSES)),
+    ('score', lambda rng, i: rng.randint(1, 5) if rng.random() > 0.05 else None),
+    ('cost_center', lambda rng, i: f'{rng.randint(1, 99999):05d}'),
+    ('remote', lambda rng, i: rng.random() < 0.3),
+    ('course_name', lambda rng, i: rng.choice(COURSES)),
+    ('comments', lambda rng, i: f'Review {i} for {rng.choice(COURSES)}' if rng.random() > 0.4 else None),
+]
+
+def column_names(columns):
+    names = []
+    for k in range(columns):
+        name, _ = COLUMNS[k % len(COLUMNS)]
+        names.append(name if k < len(COLUMNS) else f'{name}_{k // len(COLUMNS) + 1}')
+    return names
+
+def generate_workbook(path, sheets=1, rows=1000, columns=len(COLUMNS), seed=0):
+    """Write one workbook with sheets sheets of rows data rows each; same arguments give the same file"""
+    rng = random.Random(seed)
+    wb = openpyxl.Workbook(write_only=True)
+    for s in range(sheets):
+        base = SHEET_NAMES[s % len(SHEET_NAMES)]
+        ws = wb.create_sheet(base if s < len(SHEET_NAMES) else f'{base}_{s // len(SHEET_NAMES) + 1}')
+        ws.append(column_names(columns))
+        generators = [COLUMNS[k % len(COLUMNS)][1] for k in range(columns)]
+        for i in range(rows):
+            ws.append([generate(rng, i) for generate in generators])
+    wb.save(path)
+    return path
+
+def generate_dataset(folder, files=1, sheets=1, rows=1000, columns=len(COLUMNS), seed=0):
+    """Generate files workbooks in folder, reusing ones already generated with the same shape.
+
+    Returns the workbook paths.
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for f in range(files):
+        path = os.path.join(folder, f'bench_{sheets}s_{rows}r_{columns}c_{seed + f}.xlsx')
+        if not os.path.exists(path):
+            temp_path = f'{path}.tmp'
+            generate_workbook(temp_path, sheets, rows, columns, seed + f)
+            os.replace(temp_path, path)
+        paths.append(path)
+    return paths
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('out_dir')
+    parser.add_argument('--files', type=int, default=1)
+    parser.add_argument('--sheets', type=int, default=1)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--columns', type=int, default=len(COLUMNS))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for path in generate_dataset(args.out_dir, args.files, args.sheets, args.rows, args.columns, args.seed):
+        print(path)
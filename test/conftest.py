@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(TEST_DIR)
+sys.path.insert(0, REPO_ROOT)
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """app imported in a scratch working directory, so uploads and caches start empty"""
+    os.chdir(tmp_path_factory.mktemp('queryx'))
+    import app
+    return app
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+@pytest.fixture
+def upload(client):
+    """Upload a workbook from test/ through the API and return its dataset id"""
+    def upload(name):
+        with open(os.path.join(TEST_DIR, name), 'rb') as fh:
+            response = client.post('/api/datasets', data={'files': [(fh, name)]}, content_type='multipart/form-data')
+        assert response.status_code == 201
+        return response.get_json()['datasets'][0]['id']
+    return upload
@@ -0,0 +1,47 @@
+from datetime import datetime, time
+
+import duckdb
+import openpyxl
+import pytest
+
+ROWS = [
+    # code, flag_text, flag, mixed_date, iso_text, when, amount, count, note, blank, clock
+    ['00123', 'True', True, datetime(2024, 1, 5), '2024-01-05', datetime(2024, 1, 5, 9, 30), 1.5, 1, 'NA', None, time(9, 30)],
+    [None] * 11,
+    ['00456', 'False', False, '2024-02-06', '2024-02-06T10:00', datetime(2024, 2, 6), 2, None, ' ', None, time(10, 0)],
+    ['00789', 'True', None, None, '2024-03-07 11:15:00', None, '3.25', 3, 'null', '  ', None],
+    [None] * 11,
+]
+
+@pytest.fixture
+def edge_workbook(tmp_path):
+    path = tmp_path / 'edge.xlsx'
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = 'edge'
+    ws.append(['code', 'flag_text', 'flag', 'mixed_date', 'iso_text', 'when', 'amount', 'count', 'note', 'blank', 'clock'])
+    for row in ROWS:
+        ws.append(row)
+    wb.save(path)
+    return str(path)
+
+def ingested(app_module, path, target, row_count):
+    app_module.parse_sheet(path, 'edge', target, row_count)
+    with duckdb.connect() as con:
+        relation = con.sql(f"SELECT * FROM read_parquet('{target}')")
+        return dict(zip(relation.columns, map(str, relation.types))), relation.fetchall()
+
+@pytest.mark.parametrize('reader', ['openpyxl', 'calamine'])
+def test_streamed_and_pandas_paths_agree(app_module, edge_workbook, tmp_path, monkeypatch, reader):
+    pytest.importorskip({'openpyxl': 'openpyxl', 'calamine': 'python_calamine'}[reader])
+    monkeypatch.setattr(app_module, 'EXCEL_READER', reader)
+    loaded = ingested(app_module, edge_workbook, str(tmp_path / 'loaded.parquet'), 0)
+    streamed = ingested(app_module, edge_workbook, str(tmp_path / 'streamed.parquet'), app_module.STREAMING_ROW_THRESHOLD + 1)
+    assert streamed == loaded
+    types, rows = loaded
+    assert len(rows) == 3
+    assert types['code'] == types['flag_text'] == types['mixed_date'] == types['note'] == 'VARCHAR'
+    assert types['flag'] == 'BOOLEAN'
+    assert types['iso_text'] == types['when'] == 'TIMESTAMP'
+    assert types['amount'] == 'DOUBLE'
+    assert types['count'] == 'BIGINT'
@@ -0,0 +1,29 @@
+import os
+import time
+import uuid
+
+def test_job_left_running_by_a_dead_worker_is_submitted_again(app_module, client, upload):
+    dataset_id = upload('departments.xlsx')
+    sql = 'SELECT count(*) AS n FROM departments'
+    orphan = app_module.QueryJob(uuid.uuid4().hex, sql, app_module.dataset_paths([dataset_id]), None)
+    orphan.status = 'running'
+    orphan.started = time.time() - app_module.QUERY_TIMEOUT - app_module.JOB_LOST_SECONDS - 1
+    orphan.save()
+    os.utime(orphan.state_path, (0, 0))
+
+    assert client.get(f'/jobs/{orphan.id}').get_json()['status'] == 'failed'
+    result = client.post('/api/query', json={'datasets': [dataset_id], 'sql': sql, 'job_id': orphan.id}).get_json()
+    assert result['rows'] == [[12]]
+    assert result['job_id'] != orphan.id
+
+def test_idle_pooled_connections_expire_without_further_requests(app_module, upload, monkeypatch):
+    filepaths = app_module.dataset_paths([upload('employees.xlsx')])
+    key = app_module.dataset_key(filepaths, None)
+    monkeypatch.setattr(app_module, 'CONNECTION_IDLE_TIMEOUT', 1)
+    pooled, con, _ = app_module.acquire_dataset(filepaths, None)
+    app_module.release_dataset(pooled, con)
+    assert key in app_module._connections
+    deadline = time.time() + 5
+    while key in app_module._connections and time.time() < deadline:
+        time.sleep(0.1)
+    assert key not in app_module._connections
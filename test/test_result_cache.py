@@ -0,0 +1,11 @@
+def test_line_comment_does_not_swallow_the_next_line(client, upload):
+    dataset_id = upload('departments.xlsx')
+    first = client.post('/api/query', json={'datasets': [dataset_id], 'sql': 'SELECT 1 -- c\n+1 AS x'}).get_json()
+    second = client.post('/api/query', json={'datasets': [dataset_id], 'sql': 'SELECT 1 -- c +1 AS x'}).get_json()
+    assert first['rows'] == [[2]]
+    assert second['rows'] == [[1]]
+    assert not second['cached']
+
+def test_normalize_sql_keeps_literals_and_drops_comments(app_module):
+    assert app_module.normalize_sql("SELECT  1 /* a\n b */ + 1;") == 'SELECT 1 + 1'
+    assert app_module.normalize_sql("SELECT '--  x', \"a  b\" -- note") == "SELECT '--  x', \"a  b\""